@@ -0,0 +1,106 @@
+'''
+Compares the template based page writer with the streaming one.
+
+Run from the repository root::
+
+    python benchmarks/page_writer.py --urls 50000 --rounds 3
+
+Needs only Django installed, no database or network.
+'''
+import argparse
+import gzip
+import hashlib
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django
+from django.conf import settings
+
+settings.configure(
+    INSTALLED_APPS=['django.contrib.sitemaps'],
+    TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates', 'APP_DIRS': True}],
+    USE_TZ=False,
+    # Required by static_sitemaps.conf, never loaded here.
+    STATICSITEMAPS_ROOT_SITEMAP='benchmarks.sitemaps',
+)
+django.setup()
+
+from django.template import loader  # noqa: E402
+from static_sitemaps import streaming  # noqa: E402
+from static_sitemaps.compression import PythonCompressor  # noqa: E402
+
+
+def make_urls(count):
+    start = datetime(2020, 1, 1)
+    return [{
+        'location': 'https://www.example.com/items/%d/?ref=sitemap&page=%d' % (i, i // 100),
+        'lastmod': start + timedelta(minutes=i),
+        'changefreq': 'daily',
+        'priority': '0.5',
+        'alternates': [],
+    } for i in range(count)]
+
+
+def template_path(urls):
+    output = loader.render_to_string('sitemap.xml', {'urlset': urls}).encode('utf_8')
+    hash = hashlib.md5(output).hexdigest()
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='w') as f:
+        f.write(output)
+    return hash, len(buf.getvalue())
+
+
+def streaming_path(urls, level=9):
+    hasher = hashlib.md5()
+    raw = streaming.spool(streaming.iter_urlset(urls), hasher, 10 * 1024 * 1024)
+    compressed = PythonCompressor(level=level).compress_spooled(raw, 10 * 1024 * 1024)
+    compressed.seek(0, os.SEEK_END)
+    size = compressed.tell()
+    raw.close()
+    compressed.close()
+    return hasher.hexdigest(), size
+
+
+def measure(func, urls, rounds):
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        result = func(urls)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func(urls)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--urls', type=int, default=50000)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--level', type=int, default=9, help='gzip level for the streaming path')
+    args = parser.parse_args()
+
+    urls = make_urls(args.urls)
+    results = {}
+    for name, func in (('template', template_path), ('streaming', lambda urls: streaming_path(urls, args.level))):
+        results[name] = measure(func, urls, args.rounds)
+        (hash, size), elapsed, peak = results[name]
+        print('%-10s %8.3fs  peak %8.1f KiB  gz %8d bytes  md5 %s' % (name, elapsed, peak / 1024.0, size, hash))
+
+    if results['template'][0][0] != results['streaming'][0][0]:
+        print('WARNING: outputs differ')
+        return 1
+    print('speedup: %.2fx' % (results['template'][1] / results['streaming'][1]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,284 @@
+'''
+Benchmark suite for the sitemap generator pipeline.
+
+Builds synthetic sitemap sections, runs SitemapGenerator.write() against an
+in-memory or temp dir storage and reports wall time per phase, peak memory and
+storage operations. Needs only Django installed, no database or network.
+
+Run from the repository root::
+
+    python benchmarks/suite.py --sections 1000,50000,200000 --output results.json
+    python benchmarks/suite.py --sections 1000,50000,200000 --compare results.json
+
+Scenarios:
+
+cold
+    Empty storage, every page is rendered, compressed and stored.
+warm
+    Second run over unchanged data, nothing should get written.
+'''
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PHASES = ('load', 'query', 'fingerprint', 'render', 'hash', 'gzip', 'store', 'index', 'cull', 'manifest')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the sitemap generator pipeline.')
+    parser.add_argument('--sections', default='1000,50000',
+                        help='Comma separated URL counts, one synthetic section each (default: %(default)s).')
+    parser.add_argument('--scenarios', default='cold,warm', help='Comma separated, from cold and warm (default: %(default)s).')
+    parser.add_argument('--storage', choices=('memory', 'tempdir'), default='memory')
+    parser.add_argument('--limit', type=int, default=50000, help='URLs per page (default: %(default)s).')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--storage-concurrency', type=int, default=1)
+    parser.add_argument('--gzip-level', type=int, default=9)
+    parser.add_argument('--no-gzip', action='store_true')
+    parser.add_argument('--digest', default='md5', help='Digest naming the files (default: %(default)s).')
+    parser.add_argument('--digest-size', type=int, default=16, help='Digest size in bytes, for blake2b (default: %(default)s).')
+    parser.add_argument('--memory', action='store_true',
+                        help='Trace Python allocations for peak memory. Slows the run down considerably.')
+    parser.add_argument('--output', help='Write results as JSON to this file.')
+    parser.add_argument('--compare', help='Compare with results JSON of an earlier run, exit 1 on regressions.')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Relative slowdown reported as regression by --compare (default: %(default)s).')
+    return parser.parse_args(argv)
+
+
+def configure(args, media_root):
+    import django
+    from django.conf import settings
+
+    settings.configure(
+        INSTALLED_APPS=['django.contrib.sitemaps', 'static_sitemaps'],
+        TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates', 'APP_DIRS': True}],
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        USE_TZ=False,
+        # Mocked site requests are built for this host.
+        ALLOWED_HOSTS=['www.example.com'],
+        MEDIA_ROOT=media_root,
+        MEDIA_URL='/media/',
+        STATICSITEMAPS_ROOT_SITEMAP='benchmarks.synthetic.SITEMAPS',
+        STATICSITEMAPS_STORAGE=('benchmarks.synthetic.MemoryStorage' if args.storage == 'memory'
+                                else 'django.core.files.storage.FileSystemStorage'),
+        STATICSITEMAPS_MOCK_SITE=True,
+        STATICSITEMAPS_MOCK_SITE_NAME='www.example.com',
+        STATICSITEMAPS_PING_GOOGLE=False,
+        STATICSITEMAPS_USE_GZIP=not args.no_gzip,
+        STATICSITEMAPS_GZIP_LEVEL=args.gzip_level,
+        STATICSITEMAPS_DIGEST=args.digest,
+        STATICSITEMAPS_DIGEST_SIZE=args.digest_size,
+        STATICSITEMAPS_JOBS=args.jobs,
+        STATICSITEMAPS_STORAGE_CONCURRENCY=args.storage_concurrency,
+    )
+    django.setup()
+
+
+def make_generator_class():
+    from static_sitemaps.generator import SitemapGenerator
+
+    class TimedHasher(object):
+        def __init__(self, hasher, phases):
+            self.hasher = hasher
+            self.phases = phases
+
+        def update(self, data):
+            started = time.perf_counter()
+            self.hasher.update(data)
+            self.phases['hash'] += time.perf_counter() - started
+
+        def hexdigest(self):
+            return self.hasher.hexdigest()
+
+    class BenchmarkGenerator(SitemapGenerator):
+        '''
+        Generator timing the per page steps the run summary doesn't break down.
+        Phases overlap when run with jobs or storage concurrency.
+        '''
+        def __init__(self, *args, **kwargs):
+            self.phases = defaultdict(float)
+            super(BenchmarkGenerator, self).__init__(*args, **kwargs)
+
+        @contextmanager
+        def timed_phase(self, name):
+            started = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.phases[name] += time.perf_counter() - started
+
+        def get_page_urls(self, sitemap, page):
+            with self.timed_phase('query'):
+                return super(BenchmarkGenerator, self).get_page_urls(sitemap, page)
+
+        def get_fingerprint(self, sitemap, urls):
+            with self.timed_phase('fingerprint'):
+                return super(BenchmarkGenerator, self).get_fingerprint(sitemap, urls)
+
+        def get_hasher(self):
+            return TimedHasher(super(BenchmarkGenerator, self).get_hasher(), self.phases)
+
+        def iter_page_chunks(self, sitemap, page, urls=None):
+            chunks = iter(super(BenchmarkGenerator, self).iter_page_chunks(sitemap, page, urls))
+            while True:
+                started = time.perf_counter()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                finally:
+                    self.phases['render'] += time.perf_counter() - started
+                yield chunk
+
+    return BenchmarkGenerator
+
+
+def run_once(generator_class, trace_memory):
+    generator = generator_class(verbosity=0)
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    generator.write()
+    wall = time.perf_counter() - started
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    summary = generator.summary
+    timings = dict(generator.phases)
+    # Run level phases come from the generator's own summary.
+    for name in ('load', 'index', 'cull', 'manifest'):
+        timings[name] = summary.phases.get(name, 0.0)
+    # Compression and uploads run inside the storage layer, take them from its counters.
+    timings['gzip'] = summary.storage_ops.get('compress', {}).get('seconds', 0.0)
+    timings['store'] = summary.storage_ops.get('save', {}).get('seconds', 0.0)
+    phases = dict((name, round(timings.get(name, 0.0), 6)) for name in PHASES)
+    return {
+        'wall': round(wall, 6),
+        'phases': phases,
+        'pages': summary.total('pages'),
+        'pages_written': summary.total('written'),
+        'raw_bytes': summary.total('raw_bytes'),
+        'compressed_bytes': summary.total('compressed_bytes'),
+        'fingerprint_hit_rate': summary.fingerprint_hit_rate,
+        'storage_ops': summary.storage_ops,
+        'peak_traced_bytes': peak,
+        'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def reset_storage(args, media_root):
+    if args.storage == 'memory':
+        from benchmarks.synthetic import MemoryStorage
+        MemoryStorage.reset()
+    else:
+        shutil.rmtree(media_root, ignore_errors=True)
+        os.makedirs(media_root)
+    from django.core.cache import cache
+    cache.clear()
+
+
+def run(args, media_root):
+    from benchmarks import synthetic
+
+    generator_class = make_generator_class()
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    results = []
+    for count in [int(count) for count in args.sections.split(',') if count.strip()]:
+        sitemaps = synthetic.build_sitemaps([count])
+        for sitemap in sitemaps.values():
+            sitemap.limit = args.limit
+        reset_storage(args, media_root)
+        primed = False
+        for scenario in scenarios:
+            if scenario == 'cold':
+                reset_storage(args, media_root)
+            elif scenario == 'warm':
+                if not primed:
+                    run_once(generator_class, False)
+            else:
+                raise SystemExit('Unknown scenario: %s' % scenario)
+            result = run_once(generator_class, args.memory)
+            primed = True
+            result.update({'scenario': scenario, 'urls': count})
+            results.append(result)
+            print_result(result)
+    return results
+
+
+def print_result(result):
+    phases = '  '.join('%s %.3f' % (name, result['phases'][name]) for name in PHASES if result['phases'][name])
+    ops = sum(stat['count'] for name, stat in result['storage_ops'].items() if name != 'compress')
+    memory = ''
+    if result['peak_traced_bytes'] is not None:
+        memory = '  peak %.1f MiB' % (result['peak_traced_bytes'] / 1048576.0)
+    print('%-5s %9d urls %5d pages  wall %8.3fs  storage ops %6d%s' % (
+        result['scenario'], result['urls'], result['pages'], result['wall'], ops, memory))
+    print('      %s' % phases)
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = dict(((r['scenario'], r['urls']), r) for r in json.load(f)['results'])
+    regressions = []
+    for result in results:
+        before = baseline.get((result['scenario'], result['urls']))
+        if before is None:
+            continue
+        timings = [('wall', before['wall'], result['wall'])]
+        timings += [(name, before['phases'].get(name, 0.0), result['phases'].get(name, 0.0)) for name in PHASES]
+        for name, old, new in timings:
+            # Ignore tiny timings, they're mostly noise.
+            if new - old > 0.05 and new > old * (1 + threshold):
+                regressions.append('%s/%d %s: %.3fs -> %.3fs (+%.0f%%)' % (
+                    result['scenario'], result['urls'], name, old, new, (new / old - 1) * 100 if old else 100))
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return not regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    media_root = tempfile.mkdtemp(prefix='sitemaps-bench-')
+    try:
+        configure(args, media_root)
+        import django
+        results = run(args, media_root)
+    finally:
+        shutil.rmtree(media_root, ignore_errors=True)
+
+    import static_sitemaps
+    report = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'version': static_sitemaps.__versionstr__,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare and not compare(results, args.compare, args.threshold):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+'''
+Synthetic sitemaps and storage for the benchmark suite. Needs no database or network.
+'''
+import posixpath
+from datetime import datetime, timedelta
+from io import BytesIO
+
+from django.contrib.sitemaps import Sitemap
+from django.core.files.base import File
+from django.core.files.storage import Storage
+
+# Filled in by build_sitemaps(), pointed to by STATICSITEMAPS_ROOT_SITEMAP.
+SITEMAPS = {}
+
+START = datetime(2020, 1, 1)
+
+
+class SyntheticSitemap(Sitemap):
+    changefreq = 'daily'
+    priority = 0.5
+    count = 0
+    section = 'items'
+
+    def items(self):
+        # range paginates by slicing without ever materializing the items.
+        return range(self.count)
+
+    def location(self, item):
+        return '/%s/%d/' % (self.section, item)
+
+    def lastmod(self, item):
+        return START + timedelta(minutes=item)
+
+
+def build_sitemaps(counts):
+    SITEMAPS.clear()
+    for i, count in enumerate(counts):
+        section = 'section%d' % i
+        SITEMAPS[section] = type('Sitemap%d' % i, (SyntheticSitemap,), {'count': count, 'section': section})
+    return SITEMAPS
+
+
+class MemoryStorage(Storage):
+    '''
+    Storage keeping files in a dict shared by all instances, so a warm run sees the files of the cold one.
+    '''
+    files = {}
+
+    @classmethod
+    def reset(cls):
+        cls.files.clear()
+
+    def _open(self, name, mode='rb'):
+        if name not in self.files:
+            raise FileNotFoundError(name)
+        return File(BytesIO(self.files[name][0]), name=name)
+
+    def _save(self, name, content):
+        self.files[name] = (b''.join(content.chunks()), datetime.now())
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def delete(self, name):
+        self.files.pop(name, None)
+
+    def exists(self, name):
+        return name in self.files
+
+    def listdir(self, path):
+        path = path.rstrip('/') + '/'
+        dirs, files = set(), []
+        for name in self.files:
+            if not name.startswith(path):
+                continue
+            rest = name[len(path):]
+            if '/' in rest:
+                dirs.add(rest.split('/', 1)[0])
+            else:
+                files.append(rest)
+        return sorted(dirs), sorted(files)
+
+    def size(self, name):
+        return len(self.files[name][0])
+
+    def url(self, name):
+        return posixpath.join('/sitemaps-media/', name)
+
+    def get_modified_time(self, name):
+        return self.files[name][1]
+
+    def total_size(self):
+        return sum(len(content) for content, _ in self.files.values())
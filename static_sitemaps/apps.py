@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class StaticSitemapsConfig(AppConfig):
+    name = 'static_sitemaps'
+
+    def ready(self):
+        if getattr(settings, 'STATICSITEMAPS_DIRTY_MODELS', None):
+            from static_sitemaps import dirty
+            dirty.connect()
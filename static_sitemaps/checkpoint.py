@@ -0,0 +1,102 @@
+'''
+Checkpoints of the refresh in progress, letting the next run resume a failed one.
+
+Lives in the Django cache (which must be shared by all workers, like the
+refresh lock). A run records the index parts of the pages it completes in
+chunks, and forgets them once its index is written. A run resuming reuses the
+recorded pages instead of querying and rendering them again. Checkpoints expire
+STATICSITEMAPS_CHECKPOINT_TTL seconds after their last update and are ignored
+once the sitemaps (sections, their classes and page sizes), the file name
+templates or anything else the pages depend on change.
+'''
+import hashlib
+import time
+import uuid
+
+from django.core.cache import cache
+
+from static_sitemaps import conf
+
+
+class Checkpoint(object):
+    def __init__(self, key, timeout=None, interval=None):
+        self.key = key
+        self.signature = None
+        self.timeout = conf.CHECKPOINT_TTL if timeout is None else timeout
+        self.interval = conf.CHECKPOINT_INTERVAL if interval is None else interval
+        self.run_id = None
+        self.chunks = 0
+        self.pending = []
+        self.saved = None
+
+    @staticmethod
+    def get_signature(*values):
+        return hashlib.md5(repr(values).encode('utf_8')).hexdigest()
+
+    @property
+    def enabled(self):
+        return self.timeout > 0
+
+    def _chunk_key(self, chunk):
+        return '%s.%s.%d' % (self.key, self.run_id, chunk)
+
+    def start(self, signature, resume=False):
+        '''
+        Starts recording a run, returning {(section, page): parts} of the failed run resumed, if any.
+
+        Only a checkpoint recorded with the same signature is resumed.
+        '''
+        self.signature = signature
+        self.pending = []
+        self.saved = time.time()
+        header = cache.get(self.key) if resume else None
+        if not header or header['signature'] != self.signature:
+            self.run_id = uuid.uuid4().hex
+            self.chunks = 0
+            return {}
+        self.run_id = header['run_id']
+        self.chunks = header['chunks']
+        pages = {}
+        # Chunks outlived by the header are gone, their pages simply get written again.
+        chunks = cache.get_many([self._chunk_key(chunk) for chunk in range(self.chunks)])
+        for chunk in chunks.values():
+            for section, page, parts in chunk:
+                pages[(section, page)] = parts
+        return pages
+
+    def add(self, section, page, parts):
+        self.pending.append((section, page, parts))
+
+    def discard(self, paths):
+        '''
+        Drops pending pages with any of their files in paths, e.g. those that failed to store.
+        '''
+        self.pending = [
+            (section, page, parts) for section, page, parts in self.pending
+            if not any(part['path'] in paths for part in parts)
+        ]
+
+    def due(self):
+        return bool(self.pending) and time.time() - self.saved >= self.interval
+
+    def save(self):
+        '''
+        Records pending pages. Their files must all be stored by now.
+        '''
+        self.saved = time.time()
+        if not self.pending:
+            return
+        cache.set(self._chunk_key(self.chunks), self.pending, self.timeout)
+        self.chunks += 1
+        self.pending = []
+        # After the chunk, so the header never counts one that isn't there.
+        cache.set(self.key, {
+            'run_id': self.run_id,
+            'signature': self.signature,
+            'chunks': self.chunks,
+        }, self.timeout)
+
+    def clear(self):
+        # Chunks expire on their own.
+        self.pending = []
+        cache.delete(self.key)
@@ -0,0 +1,172 @@
+'''
+Compressors for sitemap pages.
+
+A compressor streams gzip data from one open file into another. Which one is
+used is set by ``STATICSITEMAPS_GZIP_METHOD``: 'python' (zlib in process),
+'system' (an external gzip compatible binary such as gzip or pigz, fed
+through pipes) or a dotted path to your own Compressor subclass.
+
+Pages can additionally be stored precompressed with brotli and zstd (see
+``STATICSITEMAPS_PRECOMPRESSED``), as siblings of the page file, for the
+passthru views to negotiate with clients. Those need the ``brotli`` and
+``zstandard`` packages.
+'''
+import gzip
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+
+from static_sitemaps import conf
+from static_sitemaps.util import _lazy_load
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Buffer size used when copying between files and pipes.
+COPY_BUFSIZE = 64 * 1024
+
+
+class Compressor(object):
+    def __init__(self, level=None):
+        self.level = conf.GZIP_LEVEL if level is None else level
+
+    def compress(self, src, dst):
+        raise NotImplementedError
+
+    def compress_spooled(self, src, max_size):
+        '''
+        Compresses an open file into a new spooled temp file, rewound and ready to read.
+        '''
+        dst = tempfile.SpooledTemporaryFile(max_size=max_size)
+        try:
+            self.compress(src, dst)
+        except BaseException:
+            dst.close()
+            raise
+        dst.seek(0)
+        return dst
+
+
+class PythonCompressor(Compressor):
+    def compress(self, src, dst):
+        with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=self.level) as f:
+            shutil.copyfileobj(src, f, COPY_BUFSIZE)
+
+
+class SystemCompressor(Compressor):
+    def __init__(self, level=None, path=None):
+        super(SystemCompressor, self).__init__(level)
+        self.path = path or conf.SYSTEM_GZIP_PATH
+
+    def _feed(self, src, pipe, errors):
+        try:
+            shutil.copyfileobj(src, pipe, COPY_BUFSIZE)
+        except (IOError, OSError) as e:
+            errors.append(e)
+        finally:
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+
+    def compress(self, src, dst):
+        process = subprocess.Popen(
+            [self.path, '-c', '-%d' % self.level],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        # Feed stdin from another thread while reading stdout here, so neither pipe fills up and blocks.
+        errors = []
+        feeder = threading.Thread(target=self._feed, args=(src, process.stdin, errors))
+        feeder.daemon = True
+        feeder.start()
+        shutil.copyfileobj(process.stdout, dst, COPY_BUFSIZE)
+        feeder.join()
+        stderr = process.stderr.read()
+        process.stdout.close()
+        process.stderr.close()
+        if process.wait() != 0:
+            raise OSError("%s exited with %s: %s" % (self.path, process.returncode, stderr.decode('utf_8', 'replace').strip()))
+        if errors:
+            raise errors[0]
+
+
+class BrotliCompressor(Compressor):
+    # Quality 11 is about 150 times slower than gzip -9 on large pages, 5 is faster than it and still smaller.
+    default_level = 5
+
+    def __init__(self, level=None):
+        if brotli is None:
+            raise ImproperlyConfigured("Brotli precompression needs the brotli package")
+        super(BrotliCompressor, self).__init__(self.default_level if level is None else level)
+
+    def compress(self, src, dst):
+        compressor = brotli.Compressor(quality=self.level)
+        while True:
+            chunk = src.read(COPY_BUFSIZE)
+            if not chunk:
+                break
+            dst.write(compressor.process(chunk))
+        dst.write(compressor.finish())
+
+
+class ZstdCompressor(Compressor):
+    # Levels of 19 and up take seconds per large page for little gain.
+    default_level = 3
+
+    def __init__(self, level=None):
+        if zstandard is None:
+            raise ImproperlyConfigured("Zstandard precompression needs the zstandard package")
+        super(ZstdCompressor, self).__init__(self.default_level if level is None else level)
+
+    def compress(self, src, dst):
+        zstandard.ZstdCompressor(level=self.level).copy_stream(src, dst, read_size=COPY_BUFSIZE, write_size=COPY_BUFSIZE)
+
+
+COMPRESSORS = {
+    'python': PythonCompressor,
+    'system': SystemCompressor,
+}
+
+# Content-Encoding: (compressor, suffix of the sibling file), best first.
+PRECOMPRESSORS = {
+    'br': (BrotliCompressor, '.br'),
+    'zstd': (ZstdCompressor, '.zst'),
+}
+PRECOMPRESSED_PREFERENCE = ('br', 'zstd')
+
+
+def get_variant_path(file_path, encoding):
+    '''
+    Returns path of the page's sibling precompressed with encoding, e.g. sitemap-x-1.<hash>.xml.br.
+    '''
+    base = file_path[:-len('.gz')] if file_path.endswith('.gz') else file_path
+    return base + PRECOMPRESSORS[encoding][1]
+
+
+def get_precompressors():
+    '''
+    Returns {encoding: compressor} for the configured precompressed variants.
+    '''
+    return dict(
+        (encoding, PRECOMPRESSORS[encoding][0](conf.PRECOMPRESSED_LEVELS.get(encoding)))
+        for encoding in conf.PRECOMPRESSED
+    )
+
+
+def get_compressor(method=None):
+    method = method or conf.GZIP_METHOD
+    if method in COMPRESSORS:
+        return COMPRESSORS[method]()
+    return _lazy_load(method)()
@@ -2,6 +2,8 @@ import os
 from django.conf import settings
 from datetime import timedelta
 
+from static_sitemaps.digests import hexdigest_length
+
 # Base sitemap config dict as stated in Django docs.
 ROOT_SITEMAP = settings.STATICSITEMAPS_ROOT_SITEMAP
 
@@ -17,16 +19,44 @@ assert PAGES_DIR, "PAGES_DIR cannot be empty since it's contents get deleted"
 # Compress the result?
 USE_GZIP = getattr(settings, 'STATICSITEMAPS_USE_GZIP', True)
 
-# How to compress it? Must be in ('python', 'system').
+# How to compress it? Either 'python', 'system' or dotted path to a static_sitemaps.compression.Compressor subclass.
 GZIP_METHOD = getattr(settings, 'STATICSITEMAPS_GZIP_METHOD', 'python')
 
-# Path to system gzip binary if system method is selected.
+# Path to system gzip binary if system method is selected. Any gzip compatible binary works, e.g. pigz.
 SYSTEM_GZIP_PATH = getattr(settings, 'STATICSITEMAPS_SYSTEM_GZIP_PATH', '/usr/bin/gzip')
 
+# Compression level, 1 (fastest) to 9 (smallest).
+GZIP_LEVEL = int(getattr(settings, 'STATICSITEMAPS_GZIP_LEVEL', 9))
+
+# Serialize pages with the streaming writer instead of the template engine.
+# Sitemaps with their own sitemap_template always use the template. None streams
+# unless the project overrides the sitemap.xml template.
+STREAM_PAGES = getattr(settings, 'STATICSITEMAPS_STREAM_PAGES', None)
+
+# Bytes of page output kept in memory before spilling over to a temp file.
+SPOOL_MAX_SIZE = int(getattr(settings, 'STATICSITEMAPS_SPOOL_MAX_SIZE', 10 * 1024 * 1024))
+
 INDEX_FILENAME_TEMPLATE = getattr(settings, 'STATICSITEMAPS_INDEX_FILENAME_TEMPLATE', 'sitemap.%(hash)s.xml')
 
+# Digest naming files after their content, see static_sitemaps.digests for the choices.
+DIGEST = getattr(settings, 'STATICSITEMAPS_DIGEST', 'md5')
+
+# Digest size in bytes, for blake2b only.
+DIGEST_SIZE = int(getattr(settings, 'STATICSITEMAPS_DIGEST_SIZE', 16))
+
+# Hex characters of the hash in file names.
+DIGEST_LENGTH = hexdigest_length(DIGEST, DIGEST_SIZE)
+
 # Validations are used as a safeguard against accidentally deleting files we didn't create
-INDEX_VALIDATION_REGEX = getattr(settings, "STATICSITEMAPS_INDEX_VALIDATION_REGEX", r'sitemap\.[a-fA-F0-9]{32}\.xml')
+INDEX_VALIDATION_REGEX = getattr(settings, "STATICSITEMAPS_INDEX_VALIDATION_REGEX",
+                                 r'sitemap\.[a-fA-F0-9]{%d}\.xml$' % DIGEST_LENGTH)
+
+# Also store pages precompressed with these encodings, from 'br' (brotli) and 'zstd', for passthru serving.
+PRECOMPRESSED = tuple(getattr(settings, 'STATICSITEMAPS_PRECOMPRESSED', ()))
+assert set(PRECOMPRESSED) <= {'br', 'zstd'}, "STATICSITEMAPS_PRECOMPRESSED may only contain 'br' and 'zstd'"
+
+# Compression level per precompressed encoding, e.g. {'br': 5, 'zstd': 3}. Unset ones use the compressor's default.
+PRECOMPRESSED_LEVELS = getattr(settings, 'STATICSITEMAPS_PRECOMPRESSED_LEVELS', {})
 
 # Template how to name the resulting sitemap pages. 
 # Will use *.xml.gz if gzipped and default template used. 
@@ -39,12 +69,19 @@ FILENAME_TEMPLATE = getattr(settings,
                             _default_filename_template)
 
 
-# sitemap-GroupsSitemap-1.e52cbb9319eb33afcf44de8a70364801.xml.gz
-_default_page_regex = r'sitemap\-\w+\-\d+\.[a-fA-F0-9]{32}\.xml'
+# sitemap-GroupsSitemap-1.e52cbb9319eb33afcf44de8a70364801.xml.gz, or sitemap-GroupsSitemap-1-2.(...) when a page got split
+_default_page_regex = r'sitemap\-\w+\-\d+(\-\d+)?\.[a-fA-F0-9]{%d}\.xml' % DIGEST_LENGTH
 if USE_GZIP:
     _default_page_regex += r'\.gz'
+# Anchored, so precompressed siblings (.xml.br, .xml.zst) don't pass for pages.
+_default_page_regex += '$'
 PAGE_VALIDATION_REGEX = getattr(settings, "STATICSITEMAPS_INDEX_VALIDATION_REGEX", _default_page_regex)
 
+# Protocol limits of a single sitemap file. Pages going over them are split into several files,
+# and an index with more pages is sharded into nested index files.
+MAX_URLS_PER_FILE = int(getattr(settings, 'STATICSITEMAPS_MAX_URLS_PER_FILE', 50000))
+MAX_FILE_SIZE = int(getattr(settings, 'STATICSITEMAPS_MAX_FILE_SIZE', 50 * 1024 * 1024))
+
 # Only for backwards compatibility, same as URL.
 DOMAIN = getattr(settings, 'STATICSITEMAPS_DOMAIN', None)
 
@@ -61,9 +98,51 @@ INDEX_TEMPLATE = getattr(settings, 'STATICSITEMAPS_INDEX_TEMPLATE',
 # Storage class to use.
 STORAGE_CLASS = getattr(settings, 'STATICSITEMAPS_STORAGE', 'django.core.files.storage.FileSystemStorage')
 
+# Number of storage saves/deletes kept in flight at once. 1 runs them inline, one by one.
+STORAGE_CONCURRENCY = int(getattr(settings, 'STATICSITEMAPS_STORAGE_CONCURRENCY', 1))
+
+# Write straight to disk (temp file + rename) when the storage is a FileSystemStorage.
+LOCAL_FAST_PATH = getattr(settings, 'STATICSITEMAPS_LOCAL_FAST_PATH', True)
+
+# fsync files written by the local fast path before renaming them into place.
+FSYNC = getattr(settings, 'STATICSITEMAPS_FSYNC', False)
+
+# Max names per call when the storage implements delete_many(names), e.g. 1000 for S3 DeleteObjects.
+STORAGE_BULK_DELETE_SIZE = int(getattr(settings, 'STATICSITEMAPS_STORAGE_BULK_DELETE_SIZE', 1000))
+
 # How often should the celery task be run.
 CELERY_TASK_REPETITION = int(getattr(settings, 'STATICSITEMAPS_REFRESH_AFTER', 60))
 
+# Split the celery refresh into subtasks writing pages on all workers, joined by a chord.
+# Needs a celery result backend.
+CELERY_DISTRIBUTED = getattr(settings, 'STATICSITEMAPS_CELERY_DISTRIBUTED', False)
+
+# Pages written by each subtask of a distributed refresh.
+CELERY_PAGES_PER_TASK = int(getattr(settings, 'STATICSITEMAPS_CELERY_PAGES_PER_TASK', 10))
+
+# Models whose changes mark sitemap sections dirty, as {'app_label.ModelName': ['section', ...]}.
+# Only dirty sections are regenerated by the refresh_dirty_sitemap task or refresh_sitemap --dirty.
+DIRTY_MODELS = getattr(settings, 'STATICSITEMAPS_DIRTY_MODELS', {})
+
+# Seconds to wait after the first change before regenerating dirty sections, batching later changes.
+DIRTY_DEBOUNCE = int(getattr(settings, 'STATICSITEMAPS_DIRTY_DEBOUNCE', 60))
+
+# Several (language, site, protocol) combinations to generate in one pass, as a list of dicts with
+# 'name', 'language', 'site', 'protocol' and optionally 'root_dir' and 'cache_key' keys.
+# Each named target is stored under ROOT_DIR/<name> by default, one without a name is the default target.
+TARGETS = getattr(settings, 'STATICSITEMAPS_TARGETS', None)
+assert not (TARGETS and CELERY_DISTRIBUTED), \
+    "STATICSITEMAPS_TARGETS can't be used with STATICSITEMAPS_CELERY_DISTRIBUTED"
+
+# Seconds without a heartbeat after which a refresh holding the lock is considered dead.
+LOCK_TIMEOUT = int(getattr(settings, 'STATICSITEMAPS_LOCK_TIMEOUT', 15 * 60))
+
+# Seconds a failed run's checkpoint is kept for the next run to resume, 0 disables checkpoints.
+CHECKPOINT_TTL = int(getattr(settings, 'STATICSITEMAPS_CHECKPOINT_TTL', 6 * 60 * 60))
+
+# Seconds between checkpoint saves, each waiting for the uploads in flight.
+CHECKPOINT_INTERVAL = int(getattr(settings, 'STATICSITEMAPS_CHECKPOINT_INTERVAL', 30))
+
 # Mock django sites framework
 MOCK_SITE = getattr(settings, 'STATICSITEMAPS_MOCK_SITE', False)
 
@@ -73,14 +152,52 @@ MOCK_SITE_NAME = getattr(settings, 'STATICSITEMAPS_MOCK_SITE_NAME', None)
 # Mock django sites framework with https | https
 MOCK_SITE_PROTOCOL = getattr(settings, 'STATICSITEMAPS_MOCK_SITE_PROTOCOL', 'http')
 
+# Number of pages generated concurrently. 1 writes them one by one.
+JOBS = int(getattr(settings, 'STATICSITEMAPS_JOBS', 1))
+
+# Kind of worker pool used when JOBS > 1. Must be in ('thread', 'process').
+# The process pool forks, so it is only available on POSIX.
+POOL = getattr(settings, 'STATICSITEMAPS_POOL', 'thread')
+assert POOL in ('thread', 'process'), "STATICSITEMAPS_POOL must be 'thread' or 'process'"
+
 # Mainly for testing, will limit the results from get_urls() for each sitemap (using [:limit])
 PER_SITEMAP_LIMIT = int(getattr(settings, 'STATICSITEMAPS_PER_SITEMAP_LIMIT', 0))
 
 # Where the sitemap index file url is saved
 CACHE_KEY = getattr(settings, 'STATICSITEMAPS_CACHE_KEY', 'sitemaps_url')
 
+# Where to keep the manifest of generated files, saving directory listings and per file
+# modified time lookups. Must be in ('storage', 'cache', None), None disables it.
+MANIFEST = getattr(settings, 'STATICSITEMAPS_MANIFEST', 'storage')
+assert MANIFEST in ('storage', 'cache', None), "STATICSITEMAPS_MANIFEST must be 'storage', 'cache' or None"
+
+# Manifest file name within ROOT_DIR, when kept in storage.
+MANIFEST_FILENAME = getattr(settings, 'STATICSITEMAPS_MANIFEST_FILENAME', 'manifest.json')
+
+# Callable, or dotted path to one, receiving (name, value, tags) for every figure of a finished run,
+# e.g. to forward them to statsd or Prometheus.
+METRICS_CALLBACK = getattr(settings, 'STATICSITEMAPS_METRICS_CALLBACK', None)
+
 # Expire old files, deleting them from storage
 # Leave this high or crawlers working off an old index may 404.
 PAGES_EXPIRE_AFTER = getattr(settings, 'PAGES_EXPIRE_AFTER', timedelta(days=2))
 
 SERVE_VIA_PASSTHRU = getattr(settings, 'STATICSITEMAPS_SERVE_VIA_PASSTHRU', False)
+
+# Hand passthru files over to the web server instead of streaming them through Django.
+# Must be in ('x-accel-redirect', 'x-sendfile', None).
+PASSTHRU_OFFLOAD = getattr(settings, 'STATICSITEMAPS_PASSTHRU_OFFLOAD', None)
+assert PASSTHRU_OFFLOAD in ('x-accel-redirect', 'x-sendfile', None), \
+    "STATICSITEMAPS_PASSTHRU_OFFLOAD must be 'x-accel-redirect', 'x-sendfile' or None"
+
+# Internal nginx location the storage paths are appended to for X-Accel-Redirect.
+PASSTHRU_OFFLOAD_PREFIX = getattr(settings, 'STATICSITEMAPS_PASSTHRU_OFFLOAD_PREFIX', '/sitemaps-internal/')
+
+# Max age of passthru pages, whose content never changes under the same name.
+PASSTHRU_MAX_AGE = int(getattr(settings, 'STATICSITEMAPS_PASSTHRU_MAX_AGE', 365 * 24 * 60 * 60))
+
+# Seconds the serving views remember the current index in process memory before asking the cache again.
+RESOLVER_TTL = int(getattr(settings, 'STATICSITEMAPS_RESOLVER_TTL', 30))
+
+# Seconds other processes wait for the one looking up the index in storage after a cache miss.
+RESOLVER_LOCK_TIMEOUT = int(getattr(settings, 'STATICSITEMAPS_RESOLVER_LOCK_TIMEOUT', 5))
@@ -0,0 +1,63 @@
+'''
+Digests naming sitemap files after their content.
+
+Which one is used is set by ``STATICSITEMAPS_DIGEST``: one of hashlib's
+'md5' (the default), 'sha1' and 'sha256', 'blake2b' with a digest size of
+``STATICSITEMAPS_DIGEST_SIZE`` bytes, or one of xxhash's 'xxh64', 'xxh3_64'
+and 'xxh3_128', which need the ``xxhash`` package.
+
+This module doesn't import conf, conf derives the validation regexes from
+``hexdigest_length``.
+'''
+import hashlib
+from functools import partial
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Hex digest length of fixed size digests.
+DIGEST_LENGTHS = {
+    'md5': 32,
+    'sha1': 40,
+    'sha256': 64,
+    'xxh64': 16,
+    'xxh3_64': 16,
+    'xxh3_128': 32,
+}
+
+# Supported digest_size of blake2b, in bytes.
+BLAKE2B_SIZES = range(1, hashlib.blake2b.MAX_DIGEST_SIZE + 1)
+
+
+def hexdigest_length(name, size):
+    '''
+    Returns the number of hex characters the digest's file names use.
+    '''
+    if name == 'blake2b':
+        if size not in BLAKE2B_SIZES:
+            raise ImproperlyConfigured('blake2b digest size must be between 1 and %d bytes'
+                                       % hashlib.blake2b.MAX_DIGEST_SIZE)
+        return size * 2
+    try:
+        return DIGEST_LENGTHS[name]
+    except KeyError:
+        raise ImproperlyConfigured('Unknown digest "%s", must be one of %s' % (
+            name, ', '.join(sorted(list(DIGEST_LENGTHS) + ['blake2b']))))
+
+
+def get_hasher_factory(name, size):
+    '''
+    Returns callable creating a new incremental hasher (with update() and hexdigest()).
+    '''
+    hexdigest_length(name, size)
+    if name == 'blake2b':
+        return partial(hashlib.blake2b, digest_size=size)
+    if name.startswith('xxh'):
+        if xxhash is None:
+            raise ImproperlyConfigured('The %s digest needs the xxhash package' % name)
+        return getattr(xxhash, name)
+    return getattr(hashlib, name)
@@ -0,0 +1,87 @@
+'''
+Tracking of sitemap sections whose content changed since the last run.
+
+Saving or deleting an instance of a model listed in
+``STATICSITEMAPS_DIRTY_MODELS`` marks its sections dirty in the cache (once
+the transaction commits). The first change also schedules the
+``refresh_dirty_sitemap`` Celery task, debounced by
+``STATICSITEMAPS_DIRTY_DEBOUNCE`` seconds so a burst of changes results in a
+single run, which regenerates only the dirty sections and reuses the previous
+run's pages for everything else.
+'''
+import logging
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from static_sitemaps import conf
+
+logger = logging.getLogger(__name__)
+
+
+def _section_key(section):
+    return '%s.dirty.%s' % (conf.CACHE_KEY, section)
+
+
+def _scheduled_key():
+    return '%s.dirty_scheduled' % conf.CACHE_KEY
+
+
+def mark_dirty(sections, schedule=True):
+    cache.set_many(dict((_section_key(section), True) for section in sections), None)
+    if schedule:
+        schedule_refresh()
+
+
+def pop_dirty_sections(sections):
+    '''
+    Returns which of the given sections are dirty, clearing their flags.
+    '''
+    keys = dict((_section_key(section), section) for section in sections)
+    found = cache.get_many(list(keys))
+    if found:
+        cache.delete_many(list(found))
+    return [section for key, section in keys.items() if key in found]
+
+
+def clear_scheduled():
+    cache.delete(_scheduled_key())
+
+
+def schedule_refresh():
+    '''
+    Schedules the refresh of dirty sections, unless one is scheduled already.
+    '''
+    if not cache.add(_scheduled_key(), True, conf.DIRTY_DEBOUNCE * 2):
+        return
+    try:
+        from static_sitemaps.tasks import refresh_dirty_sitemap
+    except ImportError:
+        # No celery, dirty sections wait for refresh_sitemap --dirty.
+        return
+    try:
+        refresh_dirty_sitemap.apply_async(countdown=conf.DIRTY_DEBOUNCE)
+    except Exception:
+        # Saving the model must not fail on the broker, the next change schedules again.
+        clear_scheduled()
+        logger.exception('Failed to schedule refresh of dirty sitemap sections')
+
+
+def connect():
+    '''
+    Connects the model signals for STATICSITEMAPS_DIRTY_MODELS.
+    '''
+    for label, sections in conf.DIRTY_MODELS.items():
+        model = apps.get_model(label)
+        handler = _make_handler(list(sections))
+        post_save.connect(handler, sender=model, weak=False, dispatch_uid='static_sitemaps.dirty.save.%s' % label)
+        post_delete.connect(handler, sender=model, weak=False, dispatch_uid='static_sitemaps.dirty.delete.%s' % label)
+
+
+def _make_handler(sections):
+    def handler(sender, **kwargs):
+        # The regeneration must see the change, so wait for it to be committed.
+        transaction.on_commit(lambda: mark_dirty(sections))
+    return handler
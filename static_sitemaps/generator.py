@@ -1,27 +1,44 @@
-import gzip
-import hashlib
+import logging
 import os
 import re
+import time
 from collections import abc
+from datetime import datetime, timedelta
+from contextlib import contextmanager
 
 
-from django.contrib.sitemaps import ping_google
+from django.conf import settings
+from django.contrib.sitemaps import Sitemap, ping_google
 from django.core.exceptions import ImproperlyConfigured
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
 from django.core.files.storage import FileSystemStorage
-from django.core.paginator import EmptyPage, PageNotAnInteger
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.urls import reverse, NoReverseMatch
 from django.template import loader
-from django.utils import translation
-from io import BytesIO
-from static_sitemaps import conf
+from django.utils import timezone, translation
+from static_sitemaps import conf, parallel, streaming
+from static_sitemaps.checkpoint import Checkpoint
+from static_sitemaps.compression import PythonCompressor, get_compressor, get_precompressors, get_variant_path
+from static_sitemaps.digests import get_hasher_factory
+from static_sitemaps.lock import LockLost
+from static_sitemaps.manifest import Manifest
+from static_sitemaps.paginator import KeysetPaginator
+from static_sitemaps.metrics import RunSummary, get_metrics_callback
+from static_sitemaps.resolver import IndexResolver, resolver
+from static_sitemaps.signals import sitemaps_generated
+from static_sitemaps.storage import StorageIO
+from static_sitemaps.targets import Target, get_targets
 from static_sitemaps.util import _lazy_load
 from django.core.cache import cache
-from datetime import datetime
 
 # More aptly "inspired" than authored, since had to heavily refactor almost all of it.
 __author__ = 'xaralis'
 
+logger = logging.getLogger(__name__)
+
+# Naive lastmods are fingerprinted as seconds since this, far cheaper than formatting them.
+NAIVE_EPOCH = datetime(1970, 1, 1)
+
 
 class SitemapGenerator(object):
     cache_key = conf.CACHE_KEY
@@ -34,28 +51,87 @@ class SitemapGenerator(object):
     page_filename_template = conf.FILENAME_TEMPLATE
     page_path_template = os.path.join(page_dir, page_filename_template)
     page_ttl = conf.PAGES_EXPIRE_AFTER
+    # Replaced index files are kept while the views may still remember them (see static_sitemaps.resolver).
+    index_ttl = timedelta(seconds=conf.RESOLVER_TTL)
+    # Nested index files are stored as pages of this pseudo section.
+    index_shard_section = 'index'
 
     # These are loaded lazily for cases where not needed, safety tests to verify files that will get deleted.
     page_filename_validation_re = None
     index_filename_validation_re = None
     dry_run = False
+    # Pick up the pages a failed run recorded in its checkpoint, if any.
+    resume = False
+    # PhaseProfiler (see static_sitemaps.profiling) profiling each phase, if set.
+    profiler = None
+    # Heartbeat (see static_sitemaps.lock) of the refresh lock the run holds, if any.
+    heartbeat = None
 
-    def __init__(self, verbosity=1):
+    def __init__(self, verbosity=1, jobs=None, target=None):
         self.verbosity = verbosity
+        self.jobs = conf.JOBS if jobs is None else jobs
+        self.target = target or Target()
+        self.language = self.target.language
+        self.resolver = resolver
+        if not self.target.is_default:
+            self.root_dir = self.target.root_dir
+            self.index_path_template = os.path.join(self.root_dir, self.index_filename_template)
+            self.page_dir = self.target.page_dir
+            self.page_path_template = os.path.join(self.page_dir, self.page_filename_template)
+            self.cache_key = self.target.cache_key
+            self.resolver = IndexResolver(cache_key='%s.index' % self.cache_key)
         self.has_changes = False
         self.storage = _lazy_load(conf.STORAGE_CLASS)()
+        self.io = StorageIO(self.storage)
+        self.compressor = get_compressor() if conf.USE_GZIP else None
+        self.precompressors = get_precompressors()
+        self.hasher_factory = get_hasher_factory(conf.DIGEST, conf.DIGEST_SIZE)
         self.sitemaps = _lazy_load(conf.ROOT_SITEMAP)
 
         if not isinstance(self.sitemaps, abc.Mapping):
             self.sitemaps = dict(enumerate(self.sitemaps))
 
+        self.sitemap_instances = {}
+        self.paginators = {}
         self.unmodified_pages = set()
         self.current_files = {}
+        self.culled_files = set()
+        self.index_shards = {}
+        self.manifest = Manifest(self.storage, path=os.path.join(self.root_dir, conf.MANIFEST_FILENAME),
+                                 cache_key='%s.manifest' % self.cache_key)
+        self.files_loaded = False
+        self.index_url = None
+        self.previous_manifest = None
+        self.checkpoint = Checkpoint('%s.checkpoint' % self.cache_key)
+        self.checkpointing = False
+        self.resumed_pages = {}
+        self.stream_pages = conf.STREAM_PAGES
+        self.summary = RunSummary()
         self.out("Config: root=%s, page_dir=%s, page_template=%s, index_template=%s" % (self.root_dir, self.page_dir, self.page_path_template, self.index_path_template))
 
-    @staticmethod
-    def get_hash(bytestream):
-        return hashlib.md5(bytestream).hexdigest()
+    def should_stream(self, sitemap):
+        '''
+        Whether the sitemap's pages are serialized by the streaming writer rather than a template.
+        '''
+        if getattr(sitemap, 'sitemap_template', None) is not None:
+            return False
+        if self.stream_pages is None:
+            # Unset, so only stream what sitemap.xml would render anyway.
+            self.stream_pages = streaming.is_default_template()
+            if not self.stream_pages:
+                self.out('sitemap.xml is overridden, rendering pages with it.', 2)
+        return self.stream_pages
+
+    def get_hash(self, bytestream):
+        hasher = self.get_hasher()
+        hasher.update(bytestream)
+        return hasher.hexdigest()
+
+    def get_hasher(self):
+        '''
+        Returns incremental hasher for page content, matching get_hash.
+        '''
+        return self.hasher_factory()
 
     @classmethod
     def get_index_url(cls):
@@ -92,13 +168,12 @@ class SitemapGenerator(object):
             cls.page_filename_validation_re = re.compile(conf.PAGE_VALIDATION_REGEX)
         return cls.index_filename_validation_re.match(filename) is not None
 
-    def get_storage_file_paths(self, dir):
+    def get_storage_file_paths(self, dir, is_valid=None):
+        is_valid = is_valid or self.is_valid_index
         try:
-            return [
-                os.path.join(dir, file)
-                for file in self.storage.listdir(dir)[1]
-                if self.is_valid_index(file)
-            ]
+            with self.io.timed('listdir'):
+                files = self.storage.listdir(dir)[1]
+            return [os.path.join(dir, file) for file in files if is_valid(file)]
         except FileNotFoundError as e:
             # Should mean bad dir
             return []
@@ -107,6 +182,11 @@ class SitemapGenerator(object):
         '''
         Returns path of index file.
         '''
+        if not all_files:
+            manifest = self.previous_manifest or self.manifest.load()
+            if manifest and manifest['index']:
+                return manifest['index']
+
         file_paths = self.get_storage_file_paths(self.root_dir)
 
         if all_files:
@@ -120,27 +200,99 @@ class SitemapGenerator(object):
         most_recent_mod = None
         most_recent_file_path = None
         for file_path in file_paths:
-            mod = self.storage.get_modified_time(file_path)
+            with self.io.timed('get_modified_time'):
+                mod = self.storage.get_modified_time(file_path)
             if not most_recent_mod or (mod and mod > most_recent_mod):
                 most_recent_mod = mod
                 most_recent_file_path = file_path
         assert most_recent_file_path, "Tried to find index file by most recently modified, but no modified times found"
         return most_recent_file_path
 
-    def get_page_urls(self, sitemap, page):
-        #self.out('Writing sitemap %s.' % filename, 2)
-        urls = []
-
-        if conf.MOCK_SITE:
-            if conf.MOCK_SITE_NAME is None:
+    def get_mock_site(self):
+        '''
+        Returns the RequestSite used with MOCK_SITE (or the target's site), built once per generator.
+        '''
+        if getattr(self, '_mock_site', None) is None:
+            site_name = self.target.site or conf.MOCK_SITE_NAME
+            if site_name is None:
                 raise ImproperlyConfigured("STATICSITEMAPS_MOCK_SITE_NAME must not be None. Try setting to www.yoursite.com")
             from django.contrib.sites.requests import RequestSite
             from django.test.client import RequestFactory
-            rs = RequestSite(RequestFactory().get('/', SERVER_NAME=conf.MOCK_SITE_NAME))
+            self._mock_site = RequestSite(RequestFactory().get('/', SERVER_NAME=site_name))
+        return self._mock_site
+
+    def get_site(self):
+        '''
+        Returns (site, protocol) to build URLs for, None meaning the sitemap's defaults.
+        '''
+        if self.target.site or conf.MOCK_SITE:
+            return self.get_mock_site(), self.target.protocol or conf.MOCK_SITE_PROTOCOL
+        return None, self.target.protocol
+
+    def can_share_items(self, sitemap):
+        '''
+        Whether the URLs of several targets can be built from the sitemap's items, fetched once.
+
+        Only lean sitemaps and those building URLs the way Sitemap does can; those overriding
+        get_urls() or _urls() (e.g. image, news or alternates sitemaps) get_urls() per target.
+        '''
+        # i18n sitemaps vary their items by language themselves.
+        if getattr(sitemap, 'i18n', False):
+            return False
+        if hasattr(sitemap, 'get_url_record'):
+            return True
+        sitemap_class = type(sitemap)
+        return (getattr(sitemap_class, 'get_urls', None) is Sitemap.get_urls
+                and getattr(sitemap_class, '_urls', None) is Sitemap._urls)
+
+    def get_page_items(self, sitemap, page):
+        '''
+        Fetches the items of a page, to build the URLs of several targets from. None if they can't be shared.
+        '''
+        if not self.can_share_items(sitemap):
+            return None
+        limit = conf.PER_SITEMAP_LIMIT or None
+        try:
+            if hasattr(sitemap, 'iter_page_items'):
+                return list(sitemap.iter_page_items(page, limit, self.get_paginator(sitemap)))
+            return list(self.get_paginator(sitemap).page(page).object_list[:limit])
+        except (EmptyPage, PageNotAnInteger):
+            return None
+
+    def get_item_urls(self, sitemap, items):
+        '''
+        Builds the URLs of already fetched items, the same way get_page_urls would (see can_share_items).
+        '''
+        site, protocol = self.get_site()
+        protocol = sitemap.get_protocol(protocol)
+        domain = sitemap.get_domain(site)
+        if hasattr(sitemap, 'get_url_record'):
+            return [sitemap.get_url_record(item, protocol, domain) for item in items]
+        urls = []
+        for item in items:
+            priority = sitemap._get('priority', item)
+            urls.append({
+                'item': item,
+                'location': '%s://%s%s' % (protocol, domain, sitemap._location(item)),
+                'lastmod': sitemap._get('lastmod', item),
+                'changefreq': sitemap._get('changefreq', item),
+                'priority': str(priority if priority is not None else ''),
+                'alternates': [],
+            })
+        return urls
+
+    def get_page_urls(self, sitemap, page):
+        #self.out('Writing sitemap %s.' % filename, 2)
+        urls = []
+        site, protocol = self.get_site()
 
         try:
-            if conf.MOCK_SITE:
-                urls = sitemap.get_urls(page, rs, protocol=conf.MOCK_SITE_PROTOCOL)
+            if hasattr(sitemap, 'iter_url_records'):
+                # Lean sitemaps (see LeanSitemapMixin) apply the limit before fetching anything.
+                urls = list(sitemap.iter_url_records(page, site, protocol=protocol, limit=conf.PER_SITEMAP_LIMIT,
+                                                     paginator=self.get_paginator(sitemap)))
+            elif site is not None or protocol is not None:
+                urls = sitemap.get_urls(page, site, protocol=protocol)
             else:
                 urls = sitemap.get_urls(page)
         except EmptyPage:
@@ -154,118 +306,643 @@ class SitemapGenerator(object):
         return urls
 
     def out(self, string, min_level=1):
-        # TODO: use real logging
+        # Always logged, printed too when running verbose enough (e.g. from the management command).
+        logger.log(logging.INFO if min_level <= 1 else logging.DEBUG, string)
         if self.verbosity >= min_level:
             print(string)
 
+    @contextmanager
+    def phase(self, name):
+        '''
+        Times a phase of the run into the summary.
+        '''
+        started = time.time()
+        try:
+            if self.profiler is not None:
+                with self.profiler.profile(name):
+                    yield
+            else:
+                yield
+        finally:
+            elapsed = time.time() - started
+            self.summary.add_phase(name, elapsed)
+            logger.debug('Phase %s took %.3fs', name, elapsed)
+
     def load_current_files(self):
         '''
-        Loads up dict of current pages with modified time.
+        Loads up dict of current pages with modified time, from the manifest if there's a usable one.
         '''
-        self.current_files = {
-            file: self.storage.get_modified_time(file)
-            for file in self.get_storage_file_paths(self.page_dir)
-        }
+        self.files_loaded = True
+        with self.io.timed('manifest_load'):
+            manifest = self.manifest.load()
+        # Single check the manifest still matches storage, e.g. it wasn't wiped.
+        if manifest and manifest['index'] and self.exists(manifest['index']):
+            self.previous_manifest = manifest
+            self.summary.manifest_hit = True
+            self.current_files = dict(manifest['files'])
+            self.out("Loaded current files from manifest: %s" % self.current_files, 2)
+            with self.io.timed('manifest_load'):
+                unfinished = self.manifest.is_unfinished()
+            if unfinished:
+                # Files stored by a run that died before saving its manifest aren't in it. Pick them up
+                # from a listing, so they expire like any other file instead of lingering (and getting
+                # stored again under another name by storages that don't overwrite).
+                self.out("Last run didn't finish, listing storage for the files it left", 1)
+                listed = self.io.modified_times(self.page_dir, self.is_valid_page)
+                listed.update(self.io.modified_times(self.root_dir, self.is_valid_index))
+                for file_path, mod in listed.items():
+                    self.current_files.setdefault(file_path, mod)
+            return
+        if self.manifest.backend:
+            self.summary.manifest_hit = False
+            self.out("Manifest missing or unusable, listing storage instead", 1)
+
+        self.current_files = self.io.modified_times(self.page_dir, self.is_valid_page)
 
-        # Add in the index file(s), which can expire immediately so no expiry stored
-        self.current_files.update({ file: None for file in self.get_index_file_path(all_files=True) })
+        # Add in the index file(s). The newest is the live one, so no expiry stored; older ones
+        # were replaced when it was written.
+        index_files = self.io.modified_times(self.root_dir, self.is_valid_index)
+        replaced = max(index_files.values()) if index_files else None
+        self.current_files.update({
+            file: None if mod == replaced else replaced
+            for file, mod in index_files.items()
+        })
         self.out("Loaded current files: %s" % self.current_files, 2)
 
-    def write(self):
+    def write_manifest(self, parts, index_file_path):
+        '''
+        Stores what this run left in storage, for the next run (and the views) to pick up.
+        '''
+        data = Manifest.empty()
+        data['index'] = index_file_path
+        data['files'] = {
+            file_path: mod
+            for file_path, mod in self.current_files.items()
+            if file_path not in self.culled_files
+        }
+        for part in parts:
+            data['files'][part['path']] = part['lastmod']
+            entry = data['pages'].setdefault(str(part['section']), {}).setdefault(str(part['page']), {
+                'files': [],
+                'fingerprint': part['fingerprint'],
+            })
+            entry['files'].append({'path': part['path'], 'lastmod': part['lastmod']})
+        data['files'].update(self.index_shards)
+        # Same as when listing, index files expire as soon as they're replaced.
+        data['files'][index_file_path] = None
+        if not self.dry_run:
+            with self.io.timed('manifest_save'):
+                self.manifest.save(data)
+
+    def mark_unfinished(self):
+        '''
+        Flags the manifest as unfinished before this run stores anything it doesn't know of yet.
+        '''
+        if not self.dry_run:
+            with self.io.timed('manifest_save'):
+                self.manifest.mark_unfinished()
+
+    def exists(self, file_path):
+        with self.io.timed('exists'):
+            return self.storage.exists(file_path)
+
+    def write(self, parts=None, sections=None):
+        '''
+        Generates all sitemaps, returning the RunSummary of the run.
+
+        Given parts of pages already written elsewhere (e.g. by distributed workers), only
+        writes the index and cleans up. Given sections, only those are regenerated and the
+        previous run's pages are reused for the rest.
+        '''
         self.out('Generating sitemaps.', 1)
-        self.load_current_files()
-        translation.activate(conf.LANGUAGE)
-        self.write_all()
-        self.cull_expired_files()
-        translation.deactivate()
+        if not self.files_loaded:
+            with self.phase('load'):
+                self.load_current_files()
+        translation.activate(self.language)
+        try:
+            if parts is None:
+                # Given parts, whoever wrote the pages flagged it already.
+                self.mark_unfinished()
+            if parts is None and sections is not None:
+                parts = self.write_sections(sections)
+            elif parts is None and self.checkpoint.enabled:
+                self.start_checkpoint()
+            parts, index_file_path = self.write_all(parts)
+            if self.checkpointing:
+                # The index is out, nothing left to resume.
+                self.checkpoint.clear()
+                self.checkpointing = False
+            with self.phase('cull'):
+                self.check_lock()
+                self.summary.culled = self.cull_expired_files()
+                self.io.barrier()
+            with self.phase('manifest'):
+                self.write_manifest(parts, index_file_path)
+        except LockLost:
+            # The checkpoint belongs to the run that took over now.
+            raise
+        except Exception:
+            self.save_failed_checkpoint()
+            raise
+        finally:
+            translation.deactivate()
+            self.io.close()
+        self.finish_summary(index_file_path)
         self.out('Finished generating sitemaps.', 1)
+        return self.summary
+
+    def finish_summary(self, index_file_path):
+        summary = self.summary
+        summary.finished = time.time()
+        summary.has_changes = self.has_changes
+        summary.index_file_path = index_file_path
+        summary.storage_ops = self.io.stats
+        self.out(summary.format(), 1)
+        callback = get_metrics_callback()
+        if callback:
+            summary.emit(callback)
+        sitemaps_generated.send(sender=self.__class__, generator=self, summary=summary)
 
     def cull_expired_files(self):
         culled_count = 0
-        for file_path, mod in self.current_files.items():
+        now = timezone.now()
+        for file_path, mod in list(self.current_files.items()):
             # Don't cull files still in use
             # NOTE: because we don't update unmodified files, they can get past the ttl and not have any delay when next update occurs. 
             # But, presuming a safely high ttl, then the file should not be getting crawled by any relatively active crawler anyhow.
             if file_path in self.unmodified_pages:
                 continue
-            if mod is None or datetime.utcnow() - mod > self.page_ttl:
+            if mod is None:
+                # Index replaced by this run. Other processes may redirect to it until their remembered
+                # index expires, so it's only culled by a run at least index_ttl from now.
+                self.current_files[file_path] = now
+                continue
+            ttl = self.page_ttl if self.is_valid_page(os.path.basename(file_path)) else self.index_ttl
+            if now - mod > ttl:
                 self.out("CULLING expired file: %s, mod: %s" % (file_path, mod), 2)
                 if not self.dry_run:
-                    self.storage.delete(file_path)
+                    self.io.delete(file_path)
+                    if self.is_valid_page(os.path.basename(file_path)):
+                        for encoding in self.precompressors:
+                            self.io.delete(get_variant_path(file_path, encoding))
+                self.culled_files.add(file_path)
                 culled_count += 1
         return culled_count
 
-    def write_all(self):
-        parts = []
-
-        # Collect all pages and write them.
-        for section, sitemap in self.sitemaps.items():
+    def get_sitemap(self, section):
+        '''
+        Returns the sitemap instance for a section, instantiating sitemap classes once per generator.
+        '''
+        if section not in self.sitemap_instances:
+            sitemap = self.sitemaps[section]
             if callable(sitemap):
                 sitemap = sitemap()
-            pages = sitemap.paginator.num_pages
+            elif hasattr(sitemap, 'reset_paginator'):
+                # Instances in ROOT_SITEMAP outlive runs, their pagination must not.
+                sitemap.reset_paginator()
+            self.sitemap_instances[section] = sitemap
+        return self.sitemap_instances[section]
+
+    def get_paginator(self, sitemap):
+        # Sitemap.paginator is a new Paginator (and COUNT query) on every access, keep one.
+        if id(sitemap) not in self.paginators:
+            self.paginators[id(sitemap)] = sitemap.paginator
+        return self.paginators[id(sitemap)]
+
+    def get_pagination(self, sections=None):
+        '''
+        Returns [section, attribute, value] of the worked out pagination of sections (all by default), for
+        set_pagination() of another generator, e.g. in a distributed subtask.
+        '''
+        pagination = []
+        for section in self.sitemaps:
+            if sections is not None and section not in sections:
+                continue
+            paginator = self.get_paginator(self.get_sitemap(section))
+            if isinstance(paginator, KeysetPaginator):
+                pagination.append([section, '_page_starts', paginator.page_starts])
+            elif isinstance(paginator, Paginator):
+                pagination.append([section, 'count', paginator.count])
+        return pagination
+
+    def set_pagination(self, pagination):
+        '''
+        Takes over pagination from get_pagination(), so page boundaries aren't walked (or rows counted) again.
+        '''
+        for section, attribute, value in pagination:
+            setattr(self.get_paginator(self.get_sitemap(section)), attribute, value)
+
+    def get_page_tasks(self, sections=None):
+        '''
+        Returns (section, page) pairs for every page to write (of the given sections only, if any), in index order.
+        '''
+        tasks = []
+        for section in self.sitemaps:
+            if sections is not None and section not in sections:
+                continue
+            pages = self.get_paginator(self.get_sitemap(section)).num_pages
+            tasks.extend((section, page) for page in range(1, pages + 1))
+        return tasks
+
+    def get_fingerprint(self, sitemap, urls):
+        '''
+        Returns a cheap fingerprint of the page's URL records, or None if the output may depend on more than them.
+        '''
+        # Custom templates can render anything from the url dicts (or the items behind them).
+        if not self.should_stream(sitemap):
+            return None
+        hasher = self.get_hasher()
+        # Output and file name also depend on these, so changing them must not match older fingerprints.
+        hasher.update(('%s\n%s\n' % (self.page_path_template, settings.TIME_ZONE)).encode('utf_8'))
+        # One compact line per URL, hashed in one go.
+        lines = []
+        for url in urls:
+            lastmod = url.get('lastmod')
+            if isinstance(lastmod, datetime):
+                lastmod = (lastmod - NAIVE_EPOCH).total_seconds() if lastmod.tzinfo is None else lastmod.timestamp()
+            alternates = url.get('alternates')
+            lines.append('%s\t%r\t%s\t%s\t%s\n' % (
+                url['location'], lastmod, url.get('changefreq'), url.get('priority'),
+                ' '.join(['%s=%s' % (alternate['lang_code'], alternate['location']) for alternate in alternates])
+                if alternates else '',
+            ))
+        hasher.update(''.join(lines).encode('utf_8'))
+        return hasher.hexdigest()
+
+    def get_unchanged_page(self, section, page, fingerprint):
+        '''
+        Returns the previous run's files for the page if its fingerprint still matches, otherwise None.
+        '''
+        if fingerprint is None or not self.previous_manifest:
+            return None
+        previous = self.previous_manifest['pages'].get(str(section), {}).get(str(page))
+        if not previous or previous.get('fingerprint') != fingerprint:
+            return None
+        file_paths = [file['path'] for file in previous['files']]
+        if not file_paths or any(file_path not in self.current_files for file_path in file_paths):
+            return None
+        return file_paths
 
-            for page in range(1, pages + 1):
-                file_path = self.write_page(sitemap, page, section)
-                # If it's an existing file (not changed), use our stored value, otherwise look it up.
-                # Could probably just use "now", but this is safer for tz issues and such.
-                lastmod = self.current_files.get(file_path, self.storage.get_modified_time(file_path))
+    def write_part(self, section, page, urls=None):
+        '''
+        Writes a single page, returning its entries for the index (more than one if the page had to be split).
+        '''
+        started = time.time()
+        sitemap = self.get_sitemap(section)
+        if urls is None:
+            urls = self.get_page_urls(sitemap, page)
+        fingerprint = self.get_fingerprint(sitemap, urls)
+        file_paths = self.get_unchanged_page(section, page, fingerprint)
+        fingerprint_hit = file_paths is not None
+        if fingerprint_hit:
+            # Same records as last time, so same output: skip rendering, hashing and compressing.
+            for file_path in file_paths:
+                self.out('Page fingerprint not modified: %s' % file_path, 2)
+                self.is_modified(file_path)
+        else:
+            file_paths = self.write_page(sitemap, page, section, urls=urls)
+        written = any(file_path not in self.current_files for file_path in file_paths)
+        self.summary.add_page(section, time.time() - started, written=written, fingerprint_hit=fingerprint_hit)
+        parts = []
+        for file_path in file_paths:
+            # If it's an existing file (not changed), use our stored value, otherwise it was just written.
+            # timezone.now() follows USE_TZ the same way storage modified times do.
+            lastmod = self.current_files.get(file_path) or timezone.now()
+            parts.append({
+                'location': self.storage.url(file_path),
+                'lastmod': lastmod,
+                'section': section,
+                'page': page,
+                'path': file_path,
+                'fingerprint': fingerprint,
+            })
+        return parts
+
+    def check_lock(self):
+        '''
+        Raises LockLost if another run took over the refresh lock, before anything gets replaced or deleted.
+        '''
+        if self.heartbeat is not None:
+            self.heartbeat.check()
+
+    def get_checkpoint_signature(self):
+        '''
+        Returns signature of whatever the recorded pages, where they're cut and their file names depend on.
+        '''
+        sitemaps = []
+        for section in self.sitemaps:
+            sitemap = self.get_sitemap(section)
+            sitemaps.append((
+                section,
+                '%s.%s' % (type(sitemap).__module__, type(sitemap).__qualname__),
+                getattr(sitemap, 'limit', None),
+                getattr(sitemap, 'keyset_field', None),
+            ))
+        return Checkpoint.get_signature(
+            conf.ROOT_SITEMAP, sitemaps, conf.PER_SITEMAP_LIMIT, self.page_path_template,
+            self.index_path_template, conf.DIGEST, conf.DIGEST_SIZE, conf.MAX_URLS_PER_FILE,
+            conf.MAX_FILE_SIZE, self.language)
+
+    def start_checkpoint(self):
+        '''
+        Starts recording completed pages, picking up those of the failed run when resuming one.
+        '''
+        self.checkpointing = True
+        self.resumed_pages = self.checkpoint.start(self.get_checkpoint_signature(), resume=self.resume)
+        if self.resumed_pages:
+            self.out('Resuming failed run, reusing %s pages.' % len(self.resumed_pages), 1)
+        for parts in self.resumed_pages.values():
+            for part in parts:
+                # Stored before they were recorded, the manifest of the last finished run just doesn't know them.
+                self.current_files.setdefault(part['path'], part['lastmod'])
+
+    def get_resumed_parts(self, section, page):
+        '''
+        Returns the page's index parts recorded by the failed run being resumed, or None.
+        '''
+        parts = self.resumed_pages.get((section, page))
+        if parts is None:
+            return None
+        for part in parts:
+            # Keep them from being culled.
+            self.is_modified(part['path'])
+        self.summary.add_page(section, 0.0, written=False, resumed=True)
+        return parts
+
+    def checkpoint_page(self, section, page, parts):
+        if not self.checkpointing:
+            return
+        self.checkpoint.add(section, page, parts)
+        if self.checkpoint.due():
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        # Only pages whose files are all stored may be recorded, so never those that failed to store,
+        # even if an earlier barrier already raised their error.
+        self.io.barrier()
+        self.checkpoint.discard(self.io.failed)
+        with self.io.timed('checkpoint_save'):
+            self.checkpoint.save()
+
+    def save_failed_checkpoint(self):
+        '''
+        Records the pages completed before the run failed, for the next run to resume.
+        '''
+        if not self.checkpointing:
+            return
+        try:
+            self.save_checkpoint()
+        except Exception:
+            logger.warning('Could not save the checkpoint of the failed run.', exc_info=True)
+
+    def write_pages(self, tasks=None):
+        '''
+        Writes pages of the (section, page) tasks, all of them by default, returning their index parts in order.
+        '''
+        if tasks is None:
+            tasks = self.get_page_tasks()
+        pending = [task for task in tasks if task not in self.resumed_pages]
+        written = {}
+        with self.phase('pages'):
+            if self.jobs > 1:
+                self.out('Writing %s pages with %s %s workers.' % (len(pending), self.jobs, conf.POOL), 1)
+                results = parallel.iter_parts(self, pending, self.jobs, conf.POOL)
+            else:
+                results = ((task, self.write_part(*task)) for task in pending)
+            for (section, page), parts in results:
+                written[(section, page)] = parts
+                self.checkpoint_page(section, page, parts)
+        parts = []
+        for section, page in tasks:
+            resumed = self.get_resumed_parts(section, page)
+            parts.extend(written[(section, page)] if resumed is None else resumed)
+        return parts
+
+    def get_previous_parts(self, section):
+        '''
+        Returns the previous run's index parts of a section, or None if they can't be reused.
+        '''
+        pages = self.previous_manifest['pages'].get(str(section)) if self.previous_manifest else None
+        if not pages:
+            return None
+        parts = []
+        for page in sorted(pages, key=int):
+            entry = pages[page]
+            for file in entry['files']:
+                if file['path'] not in self.current_files:
+                    return None
                 parts.append({
-                    'location': self.storage.url(file_path),
-                    'lastmod': lastmod
+                    'location': self.storage.url(file['path']),
+                    'lastmod': file['lastmod'],
+                    'section': section,
+                    'page': int(page),
+                    'path': file['path'],
+                    'fingerprint': entry['fingerprint'],
                 })
+        return parts
+
+    def write_sections(self, sections):
+        '''
+        Writes pages of the given sections only, returning index parts of all sections with the
+        previous run's parts reused for the others.
+        '''
+        dirty = set(str(section) for section in sections)
+        reused = {}
+        for section in self.sitemaps:
+            if str(section) not in dirty:
+                reused[section] = self.get_previous_parts(section)
+                if reused[section] is None:
+                    # Nothing to reuse (e.g. a new section or no manifest), so write it too.
+                    dirty.add(str(section))
+        self.out('Regenerating sections: %s' % ', '.join(sorted(dirty)), 1)
+        tasks = self.get_page_tasks([section for section in self.sitemaps if str(section) in dirty])
+        written = {}
+        for part in self.write_pages(tasks):
+            written.setdefault(part['section'], []).append(part)
+
+        parts = []
+        for section in self.sitemaps:
+            if str(section) in dirty:
+                parts.extend(written.get(section, []))
+            else:
+                for part in reused[section]:
+                    # Keep them from being culled.
+                    self.is_modified(part['path'])
+                parts.extend(reused[section])
+        return parts
+
+    def write_all(self, parts=None):
+        # Collect all pages and write them.
+        if parts is None:
+            parts = self.write_pages()
 
-        index_file_path = self.write_index(parts)
-        self.ping_google()
+        with self.phase('index'):
+            self.check_lock()
+            index_file_path = self.write_index(parts)
+        with self.phase('ping'):
+            self.ping_google()
+        return parts, index_file_path
+
+    def write_index_shards(self, parts):
+        '''
+        Writes parts into nested index files of at most MAX_URLS_PER_FILE entries, returning entries for the root index.
+        '''
+        shards = []
+        size = conf.MAX_URLS_PER_FILE
+        for shard, start in enumerate(range(0, len(parts), size), 1):
+            entries = parts[start:start + size]
+            hasher = self.get_hasher()
+            output = streaming.spool(
+                [loader.render_to_string(conf.INDEX_TEMPLATE, {'sitemaps': entries}).encode('utf_8')],
+                hasher, conf.SPOOL_MAX_SIZE)
+            file_path = self.page_path_template % {
+                'section': self.index_shard_section, 'page': shard, 'hash': hasher.hexdigest()}
+            if self.is_modified(file_path):
+                self.out('Writing index shard: %s' % file_path, 2)
+                self.io.submit(self.store_page, file_path, output, self.index_shard_section, name=file_path)
+            else:
+                output.close()
+            self.index_shards[file_path] = self.current_files.get(file_path) or timezone.now()
+            lastmods = [entry['lastmod'] for entry in entries if entry['lastmod']]
+            shards.append({
+                'location': self.storage.url(file_path),
+                'lastmod': max(lastmods) if lastmods else None,
+                'path': file_path,
+            })
+        return shards
 
     def write_index(self, parts):
+        if len(parts) > conf.MAX_URLS_PER_FILE:
+            self.out('%s pages are over the limit of a single index, sharding it.' % len(parts), 1)
+            parts = self.write_index_shards(parts)
         output = loader.render_to_string(
             conf.INDEX_TEMPLATE,
             {'sitemaps': parts}
         ).encode('utf_8')
         hash = self.get_hash(output)
         file_path = self.index_path_template % { 'hash': hash }
+        # Every page the index points to must be stored before the index is.
+        self.io.barrier()
         if self.is_modified(file_path):
             self.out('Writing index file: %s' % file_path, 2)
             self.has_changes = True
-            self.storage.save(file_path, ContentFile(output))
+            self.io.save(file_path, ContentFile(output))
+            self.io.barrier()
         else:
             self.out('Index file (and, as such, sitemap pages) not modified', 2)
         # Go ahead and update cache, even if not changed.
         url = self.storage.url(file_path)
         cache.set(self.cache_key, url)
+        self.index_url = url
+        self.resolver.publish(file_path, url)
+        return file_path
 
-    def write_page(self, sitemap, page, section):
+    def iter_page_chunks(self, sitemap, page, urls=None):
         '''
-        Renders template and stores to file based on sitemap/page/section and content hash, returning file path.
+        Yields the encoded page output in chunks, streaming unless the sitemap asks for its own template.
         '''
-        template = getattr(sitemap, 'sitemap_template', 'sitemap.xml')
-        # Encode it now, both hash and f.write require it.
-        output = loader.render_to_string(
-            template,
-            {'urlset': self.get_page_urls(sitemap, page)}
-        ).encode('utf_8')
-        # NOTE: hash based on raw content, BEFORE gzip. However, changing to not zip will
-        # change the default filename and thereby invalidate the stored file.
-        hash = self.get_hash(output)
-        file_path = self.page_path_template % {'section': section, 'page': page, 'hash': hash}
+        if urls is None:
+            urls = self.get_page_urls(sitemap, page)
+        if self.should_stream(sitemap):
+            return streaming.iter_urlset(urls)
+        template = getattr(sitemap, 'sitemap_template', None) or 'sitemap.xml'
+        return [loader.render_to_string(template, {'urlset': urls}).encode('utf_8')]
+
+    def render_page(self, sitemap, page, urls):
+        '''
+        Renders page to spooled files within the protocol limits, returning (output, hash, size) for each.
+        '''
+        size = conf.MAX_URLS_PER_FILE
+        groups = [urls[i:i + size] for i in range(0, len(urls), size)] or [urls]
+        outputs = []
+        while groups:
+            group = groups.pop(0)
+            hasher = self.get_hasher()
+            output = streaming.spool(self.iter_page_chunks(sitemap, page, group), hasher, conf.SPOOL_MAX_SIZE)
+            output.seek(0, os.SEEK_END)
+            raw_size = output.tell()
+            if raw_size > conf.MAX_FILE_SIZE and len(group) > 1:
+                # Too big even within the URL limit, try again in halves.
+                output.close()
+                half = len(group) // 2
+                groups[0:0] = [group[:half], group[half:]]
+                continue
+            output.seek(0)
+            outputs.append((output, hasher.hexdigest(), raw_size))
+        return outputs
+
+    def write_page(self, sitemap, page, section, urls=None):
+        '''
+        Renders page and stores to file(s) based on sitemap/page/section and content hash, returning file paths.
+
+        Pages over the protocol limits are split, stored as page-1, page-2 and so on.
+        '''
+        if urls is None:
+            urls = self.get_page_urls(sitemap, page)
+        outputs = self.render_page(sitemap, page, urls)
+        file_paths = []
+        for split, (output, hash, raw_size) in enumerate(outputs, 1):
+            # NOTE: hash based on raw content, BEFORE gzip. However, changing to not zip will
+            # change the default filename and thereby invalidate the stored file.
+            name = '%s-%s' % (page, split) if len(outputs) > 1 else page
+            file_path = self.page_path_template % {'section': section, 'page': name, 'hash': hash}
+            file_paths.append(file_path)
+
+            if not self.is_modified(file_path):
+                self.out('Page not modified: %s' % file_path , 2)
+                output.close()
+                continue
+            self.out('Writing page: %s' % file_path , 2)
+            self.summary.add_bytes(section, raw=raw_size)
 
-        if not self.is_modified(file_path):
-            self.out('Page not modified: %s' % file_path , 2)
-            return file_path
-        self.out('Writing page: %s' % file_path , 2)
+            # Compressed and stored in the background, letting the next page render meanwhile.
+            self.io.submit(self.store_page, file_path, output, section, name=file_path)
+        return file_paths
+
+    def compress(self, file_path, output):
+        '''
+        Returns compressed copy of the spooled output, falling back to in process gzip if the configured compressor fails.
+        '''
+        try:
+            with self.io.timed('compress'):
+                return self.compressor.compress_spooled(output, conf.SPOOL_MAX_SIZE)
+        except OSError as e:
+            if isinstance(self.compressor, PythonCompressor):
+                raise
+            self.out("Compress %s file error: %s, falling back to python gzip" % (file_path, e))
+            output.seek(0)
+            with self.io.timed('compress'):
+                return PythonCompressor().compress_spooled(output, conf.SPOOL_MAX_SIZE)
 
-        if conf.USE_GZIP:
+    def store_variants(self, file_path, output):
+        '''
+        Stores the precompressed siblings of a page, before the page itself so they're there whenever it is.
+        '''
+        for encoding, compressor in self.precompressors.items():
+            output.seek(0)
+            with self.io.timed('compress_%s' % encoding):
+                compressed = compressor.compress_spooled(output, conf.SPOOL_MAX_SIZE)
             try:
+                self.io.write(get_variant_path(file_path, encoding), File(compressed))
+            finally:
+                compressed.close()
+        output.seek(0)
+
+    def store_page(self, file_path, output, section):
+        try:
+            if self.precompressors:
+                self.store_variants(file_path, output)
+            if self.compressor:
                 self.out('Compressing...', 2)
-                buf = BytesIO()
-                with gzip.GzipFile(fileobj=buf, mode="w") as f:
-                    f.write(output)
-                output = buf.getvalue()
-            except OSError:
-                self.out("Compress %s file error" % file_path)
-
-        self.storage.save(file_path, ContentFile(output))
-        return file_path
+                compressed = self.compress(file_path, output)
+                output.close()
+                output = compressed
+            output.seek(0, os.SEEK_END)
+            self.summary.add_bytes(section, compressed=output.tell())
+            output.seek(0)
+            self.io.write(file_path, File(output))
+        finally:
+            output.close()
 
     def is_modified(self, file_path):
         if file_path in self.current_files:
@@ -277,10 +954,81 @@ class SitemapGenerator(object):
     def ping_google(self):
         if conf.PING_GOOGLE:
             try:
+                # Only the default target is served by the views.
+                if not self.target.is_default:
+                    raise NoReverseMatch
                 sitemap_url = reverse('static_sitemaps_index')
             except NoReverseMatch:
-                sitemap_url = self.get_index_url()
+                sitemap_url = self.index_url
 
             self.out('Pinging google...', 2)
             ping_google(sitemap_url)
 
+
+
+class MultiTargetGenerator(object):
+    '''
+    Generates sitemaps for several targets (see static_sitemaps.targets), fetching each page's items once for all.
+    '''
+    def __init__(self, targets=None, verbosity=1, generator_class=SitemapGenerator):
+        targets = targets or get_targets()
+        self.generators = [generator_class(verbosity, jobs=1, target=target) for target in targets]
+        first = self.generators[0]
+        for generator in self.generators[1:]:
+            # Shared, so pagination (counts, keyset boundaries) is worked out once too.
+            generator.sitemaps = first.sitemaps
+            generator.sitemap_instances = first.sitemap_instances
+            generator.paginators = first.paginators
+
+    @property
+    def sitemaps(self):
+        return self.generators[0].sitemaps
+
+    def out(self, string, min_level=1):
+        self.generators[0].out(string, min_level)
+
+    def write_part(self, section, page, parts):
+        '''
+        Writes a page for all targets, querying its items once, and adds their index parts to parts.
+        '''
+        first = self.generators[0]
+        resumed = dict((generator, generator.get_resumed_parts(section, page)) for generator in self.generators)
+        items = None
+        if any(generator_parts is None for generator_parts in resumed.values()):
+            sitemap = first.get_sitemap(section)
+            with first.phase('query'):
+                items = first.get_page_items(sitemap, page)
+        for generator in self.generators:
+            if resumed[generator] is not None:
+                parts[generator].extend(resumed[generator])
+                continue
+            # Locations may depend on the active language, e.g. with i18n_patterns.
+            with translation.override(generator.language):
+                urls = None if items is None else generator.get_item_urls(sitemap, items)
+                page_parts = generator.write_part(section, page, urls=urls)
+            parts[generator].extend(page_parts)
+            generator.checkpoint_page(section, page, page_parts)
+
+    def write(self, sections=None):
+        '''
+        Generates sitemaps of all targets, returning their RunSummary in order.
+        '''
+        if sections is not None:
+            # Dirty sections are few, regenerate them target by target.
+            return [generator.write(sections=sections) for generator in self.generators]
+        first = self.generators[0]
+        for generator in self.generators:
+            with generator.phase('load'):
+                generator.load_current_files()
+            generator.mark_unfinished()
+            if generator.checkpoint.enabled:
+                generator.start_checkpoint()
+        parts = dict((generator, []) for generator in self.generators)
+        try:
+            for section, page in first.get_page_tasks():
+                self.write_part(section, page, parts)
+        except Exception:
+            for generator in self.generators:
+                generator.save_failed_checkpoint()
+            raise
+        return [generator.write(parts=parts[generator]) for generator in self.generators]
@@ -0,0 +1,97 @@
+'''
+Cluster wide lock making sure only one sitemap refresh runs at a time.
+
+Lives in the Django cache (which must be shared by all workers, e.g. memcached
+or redis). The holder keeps it alive by heartbeats; a run that stops beating
+for longer than the timeout is considered dead and the next run takes over.
+'''
+import logging
+import threading
+import uuid
+
+from django.core.cache import cache
+
+from static_sitemaps import conf
+
+logger = logging.getLogger(__name__)
+
+
+class LockLost(Exception):
+    '''
+    Raised by a run whose lock expired and was taken over by another run.
+    '''
+
+
+class RefreshLock(object):
+    def __init__(self, key=None, timeout=None):
+        self.key = key or '%s.refresh_lock' % conf.CACHE_KEY
+        self.timeout = timeout or conf.LOCK_TIMEOUT
+
+    def acquire(self):
+        '''
+        Returns id of the new run holding the lock, or None if another live run holds it.
+        '''
+        run_id = uuid.uuid4().hex
+        # An expired (stale) lock is gone from the cache, so add() takes it over.
+        if cache.add(self.key, run_id, self.timeout):
+            return run_id
+        return None
+
+    def owns(self, run_id):
+        return run_id is not None and cache.get(self.key) == run_id
+
+    def heartbeat(self, run_id):
+        '''
+        Extends the lock, raising LockLost if another run has taken it over meanwhile.
+        '''
+        if not self.owns(run_id):
+            raise LockLost("Sitemap refresh %s lost its lock" % run_id)
+        cache.set(self.key, run_id, self.timeout)
+
+    def release(self, run_id):
+        if self.owns(run_id):
+            cache.delete(self.key)
+
+
+class Heartbeat(threading.Thread):
+    '''
+    Background thread keeping a lock alive while a run is in progress.
+    '''
+    def __init__(self, lock, run_id, interval=None):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.lock = lock
+        self.run_id = run_id
+        self.interval = interval or max(self.lock.timeout / 3.0, 1)
+        self.lost = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.lock.heartbeat(self.run_id)
+            except LockLost:
+                self.lost = True
+                return
+            except Exception:
+                # E.g. the cache being briefly unreachable, keep beating.
+                logger.exception('Sitemap refresh %s failed to extend its lock', self.run_id)
+
+    def check(self):
+        '''
+        Raises LockLost if the run no longer holds the lock, extending it otherwise.
+        '''
+        if self.lost:
+            raise LockLost("Sitemap refresh %s lost its lock" % self.run_id)
+        self.lock.heartbeat(self.run_id)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,5 +1,8 @@
-from django.core.management.base import BaseCommand
-from static_sitemaps.generator import SitemapGenerator
+from django.core.management.base import BaseCommand, CommandError
+from static_sitemaps import conf, dirty
+from static_sitemaps.generator import MultiTargetGenerator, SitemapGenerator
+from static_sitemaps.lock import Heartbeat, RefreshLock
+from static_sitemaps.profiling import PhaseProfiler
 
 __author__ = 'xaralis'
 
@@ -8,6 +11,86 @@ class Command(BaseCommand):
     command = None
     help = 'Generates sitemaps files to a predefined directory.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--jobs', type=int, default=None,
+                            help='Number of pages to generate concurrently. Defaults to STATICSITEMAPS_JOBS.')
+        parser.add_argument('--dirty', action='store_true',
+                            help='Only regenerate sections marked dirty by model changes, if any.')
+        parser.add_argument('--section', action='append', dest='sections',
+                            help='Only regenerate this section, keeping the current pages of the others. Repeatable.')
+        parser.add_argument('--resume', action='store_true',
+                            help='Pick up where a failed run stopped, reusing the pages recorded in its checkpoint.')
+        parser.add_argument('--profile', action='store_true',
+                            help='Profile each phase with cProfile and tracemalloc and print the top entries. '
+                                 'Runs with a single job.')
+        parser.add_argument('--profile-top', type=int, default=20,
+                            help='Number of functions and allocation sites listed per phase.')
+        parser.add_argument('--profile-dir',
+                            help='Also write <phase>.prof files for each phase to this directory.')
+
     def handle(self, *args, **options):
-        generator = SitemapGenerator(int(options.get('verbosity', 0)))
-        generator.write()
+        verbosity = int(options.get('verbosity', 0))
+        jobs = options.get('jobs')
+        if options.get('profile'):
+            # Only the main thread gets profiled.
+            jobs = 1
+        if conf.TARGETS:
+            generator = MultiTargetGenerator(verbosity=verbosity)
+            generators = generator.generators
+        else:
+            generator = SitemapGenerator(verbosity, jobs=jobs)
+            generators = [generator]
+        for target_generator in generators:
+            target_generator.resume = options.get('resume', False)
+
+        # Same lock as the celery tasks, so runs from cron never cull or write the manifest concurrently.
+        lock = RefreshLock()
+        run_id = lock.acquire()
+        if run_id is None:
+            if options.get('dirty'):
+                # Dirty sections stay marked for the next run.
+                generator.out('Sitemap refresh already running, skipping.', 1)
+                return
+            raise CommandError('Another sitemap refresh is running, try again once it is done.')
+        try:
+            with Heartbeat(lock, run_id) as heartbeat:
+                for target_generator in generators:
+                    target_generator.heartbeat = heartbeat
+                self.refresh(generator, generators, options)
+        finally:
+            lock.release(run_id)
+
+    def refresh(self, generator, generators, options):
+        sections = None
+        if options.get('sections'):
+            by_name = dict((str(section), section) for section in generator.sitemaps)
+            unknown = [name for name in options['sections'] if name not in by_name]
+            if unknown:
+                raise CommandError('Unknown sections: %s (available: %s)' % (
+                    ', '.join(unknown), ', '.join(sorted(by_name))))
+            sections = [by_name[name] for name in options['sections']]
+        elif options.get('dirty'):
+            sections = dirty.pop_dirty_sections(generator.sitemaps)
+            if not sections:
+                generator.out('No dirty sections.', 1)
+                return
+
+        profiler = None
+        if options.get('profile'):
+            profiler = PhaseProfiler(top=options['profile_top'], ignore=[SitemapGenerator.phase])
+            for target_generator in generators:
+                target_generator.profiler = profiler
+            profiler.start()
+        try:
+            generator.write(sections=sections)
+        except BaseException:
+            if options.get('dirty') and sections:
+                dirty.mark_dirty(sections, schedule=False)
+            raise
+        finally:
+            if profiler is not None:
+                profiler.stop()
+        if profiler is not None:
+            self.stdout.write(profiler.format())
+            if options.get('profile_dir'):
+                profiler.dump(options['profile_dir'])
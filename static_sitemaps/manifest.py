@@ -0,0 +1,211 @@
+'''
+Manifest of the files a generator run left behind.
+
+Keeps the current index, every live file with its lastmod and the files (plus
+URL fingerprint) each section/page was written to, so the next run reads one document instead of
+listing directories and asking storage for each file's modified time. A page has
+more than one file when it went over the protocol limits and had to be split.
+
+A run storing files flags the manifest as unfinished until it saves its own, so
+the next run knows to list storage for files a failed run left behind.
+'''
+import json
+import os
+import tempfile
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.utils.dateparse import parse_datetime
+
+from static_sitemaps import conf
+from static_sitemaps.storage import _get_umask
+
+
+class Manifest(object):
+    version = 2
+
+    def __init__(self, storage, backend=None, path=None, cache_key=None):
+        self.storage = storage
+        self.backend = conf.MANIFEST if backend is None else backend
+        self.path = path or os.path.join(conf.ROOT_DIR, conf.MANIFEST_FILENAME)
+        self.cache_key = cache_key or '%s.manifest' % conf.CACHE_KEY
+
+    @staticmethod
+    def empty():
+        return {'index': None, 'files': {}, 'pages': {}}
+
+    @staticmethod
+    def _dump_datetime(value):
+        return value.isoformat() if value is not None else None
+
+    @staticmethod
+    def _load_datetime(value):
+        if value is None:
+            return None
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValueError("Invalid datetime: %r" % value)
+        return parsed
+
+    def dumps(self, data):
+        return json.dumps({
+            'version': self.version,
+            'index': data['index'],
+            'files': {path: self._dump_datetime(mod) for path, mod in data['files'].items()},
+            'pages': {
+                section: {
+                    page: {
+                        'files': [
+                            {'path': file['path'], 'lastmod': self._dump_datetime(file['lastmod'])}
+                            for file in entry['files']
+                        ],
+                        'fingerprint': entry.get('fingerprint'),
+                    }
+                    for page, entry in pages.items()
+                }
+                for section, pages in data['pages'].items()
+            },
+        }, separators=(',', ':'), sort_keys=True)
+
+    def loads(self, raw):
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf_8')
+        data = json.loads(raw)
+        if data.get('version') != self.version:
+            raise ValueError("Unsupported manifest version: %r" % data.get('version'))
+        return {
+            'index': data['index'],
+            'files': {path: self._load_datetime(mod) for path, mod in data['files'].items()},
+            'pages': {
+                section: {
+                    page: {
+                        'files': [
+                            {'path': file['path'], 'lastmod': self._load_datetime(file['lastmod'])}
+                            for file in entry['files']
+                        ],
+                        'fingerprint': entry.get('fingerprint'),
+                    }
+                    for page, entry in pages.items()
+                }
+                for section, pages in data['pages'].items()
+            },
+        }
+
+    @property
+    def unfinished_path(self):
+        return self.path + '.unfinished'
+
+    def mark_unfinished(self):
+        '''
+        Flags that files not in the manifest are about to be stored, until the next save().
+        '''
+        if not self.backend:
+            return
+        if self.backend == 'cache':
+            cache.set('%s.unfinished' % self.cache_key, True, None)
+        elif not self.storage.exists(self.unfinished_path):
+            self._save_as(self.unfinished_path, b'')
+
+    def is_unfinished(self):
+        '''
+        Whether a run stored files without saving the manifest afterwards, e.g. because it failed.
+        '''
+        if self.backend == 'cache':
+            return cache.get('%s.unfinished' % self.cache_key) is not None
+        return self.storage.exists(self.unfinished_path)
+
+    @property
+    def swap_path(self):
+        # Holds the new manifest while a storage that can't overwrite replaces it, see _replace_remote.
+        return self.path + '.new'
+
+    def _read_path(self, path):
+        try:
+            with self.storage.open(path, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def read(self):
+        if self.backend == 'cache':
+            return cache.get(self.cache_key)
+        raw = self._read_path(self.path)
+        if raw is None:
+            # Replaced right now, or the run replacing it died half way.
+            raw = self._read_path(self.swap_path)
+        return raw
+
+    def load(self):
+        '''
+        Returns the manifest data, or None when disabled, missing or corrupt.
+        '''
+        if not self.backend:
+            return None
+        raw = self.read()
+        if raw is None:
+            return None
+        try:
+            return self.loads(raw)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    def save(self, data):
+        if not self.backend:
+            return
+        raw = self.dumps(data)
+        if self.backend == 'cache':
+            cache.set(self.cache_key, raw, None)
+            cache.delete('%s.unfinished' % self.cache_key)
+            return
+        try:
+            local_path = self.storage.path(self.path)
+        except NotImplementedError:
+            local_path = None
+        if local_path:
+            self._replace_local(local_path, raw.encode('utf_8'))
+        else:
+            self._replace_remote(raw.encode('utf_8'))
+        self.storage.delete(self.unfinished_path)
+
+    def _replace_local(self, local_path, raw):
+        # Write next to the target and rename over it, readers never see a partial file.
+        directory = os.path.dirname(local_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.manifest-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(raw)
+                if conf.FSYNC:
+                    f.flush()
+                    os.fsync(f.fileno())
+            # mkstemp creates it private, give it the permissions of any other stored file.
+            mode = self.storage.file_permissions_mode
+            os.chmod(tmp_path, 0o666 & ~_get_umask() if mode is None else mode)
+            os.replace(tmp_path, local_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _save_as(self, path, raw):
+        saved_path = self.storage.save(path, ContentFile(raw))
+        if saved_path != path:
+            # Storage refused to reuse the name, don't leave a manifest nobody reads around.
+            self.storage.delete(saved_path)
+
+    def _replace_remote(self, raw):
+        if not self.storage.exists(self.path):
+            # Nothing to replace, or a swap died half way and readers use the swap copy meanwhile.
+            self._save_as(self.path, raw)
+            self.storage.delete(self.swap_path)
+            return
+        if self.storage.get_available_name(self.path) == self.path:
+            # The storage overwrites (e.g. S3 with file_overwrite), replacing the object whole on PUT.
+            self._save_as(self.path, raw)
+            return
+        # No rename in the Storage API, so keep a complete copy under swap_path while the manifest
+        # is deleted and saved again. Readers (and runs after a crash) always find one of them.
+        self.storage.delete(self.swap_path)
+        self._save_as(self.swap_path, raw)
+        self.storage.delete(self.path)
+        self._save_as(self.path, raw)
+        self.storage.delete(self.swap_path)
@@ -0,0 +1,160 @@
+'''
+Per-run summary and metrics hooks for the generator.
+
+Every run fills a RunSummary with phase durations, per-section page counts
+and timings, bytes written before and after compression, manifest and
+fingerprint hit rates and storage operation counters. When the run finishes
+the summary is logged, each figure is handed to the optional
+``STATICSITEMAPS_METRICS_CALLBACK`` (statsd/Prometheus style) and the
+``sitemaps_generated`` signal is sent with it.
+'''
+import logging
+import threading
+import time
+
+from static_sitemaps import conf
+from static_sitemaps.util import _lazy_load
+
+logger = logging.getLogger(__name__)
+
+
+def get_metrics_callback():
+    if not conf.METRICS_CALLBACK:
+        return None
+    if callable(conf.METRICS_CALLBACK):
+        return conf.METRICS_CALLBACK
+    return _lazy_load(conf.METRICS_CALLBACK)
+
+
+def new_section_stats():
+    return {
+        'pages': 0,
+        'written': 0,
+        'unmodified': 0,
+        'fingerprint_hits': 0,
+        'resumed': 0,
+        'seconds': 0.0,
+        'raw_bytes': 0,
+        'compressed_bytes': 0,
+    }
+
+
+class RunSummary(object):
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.phases = {}
+        self.sections = {}
+        self.manifest_hit = None
+        self.culled = 0
+        self.has_changes = False
+        self.index_file_path = None
+        self.storage_ops = {}
+        self._lock = threading.Lock()
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def _section(self, section):
+        return self.sections.setdefault(str(section), new_section_stats())
+
+    def add_page(self, section, seconds, written, fingerprint_hit=False, resumed=False):
+        with self._lock:
+            stats = self._section(section)
+            stats['pages'] += 1
+            stats['seconds'] += seconds
+            if written:
+                stats['written'] += 1
+            else:
+                stats['unmodified'] += 1
+            if fingerprint_hit:
+                stats['fingerprint_hits'] += 1
+            if resumed:
+                stats['resumed'] += 1
+
+    def add_bytes(self, section, raw=0, compressed=0):
+        with self._lock:
+            stats = self._section(section)
+            stats['raw_bytes'] += raw
+            stats['compressed_bytes'] += compressed
+
+    def merge_sections(self, sections):
+        with self._lock:
+            for section, other in sections.items():
+                stats = self._section(section)
+                for key, value in other.items():
+                    stats[key] += value
+
+    def total(self, key):
+        return sum(stats[key] for stats in self.sections.values())
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def fingerprint_hit_rate(self):
+        pages = self.total('pages')
+        return float(self.total('fingerprint_hits')) / pages if pages else 0.0
+
+    def to_dict(self):
+        '''
+        Plain, JSON serializable version of the summary, e.g. as a Celery task result.
+        '''
+        return {
+            'started': self.started,
+            'finished': self.finished,
+            'duration': self.duration,
+            'phases': dict(self.phases),
+            'sections': dict((section, dict(stats)) for section, stats in self.sections.items()),
+            'pages': self.total('pages'),
+            'pages_written': self.total('written'),
+            'pages_resumed': self.total('resumed'),
+            'raw_bytes': self.total('raw_bytes'),
+            'compressed_bytes': self.total('compressed_bytes'),
+            'manifest_hit': self.manifest_hit,
+            'fingerprint_hit_rate': self.fingerprint_hit_rate,
+            'culled': self.culled,
+            'has_changes': self.has_changes,
+            'index_file_path': self.index_file_path,
+            'storage_ops': dict((operation, dict(stat)) for operation, stat in self.storage_ops.items()),
+        }
+
+    def format(self):
+        lines = [
+            'Sitemaps generated in %.2fs: %d pages, %d written, %d resumed, %d bytes raw, %d compressed, %d culled.' % (
+                self.duration, self.total('pages'), self.total('written'), self.total('resumed'),
+                self.total('raw_bytes'), self.total('compressed_bytes'), self.culled),
+            'Phases: %s' % ', '.join('%s %.2fs' % (name, seconds) for name, seconds in sorted(self.phases.items())),
+            'Manifest hit: %s, fingerprint hit rate: %.0f%%' % (self.manifest_hit, self.fingerprint_hit_rate * 100),
+        ]
+        for section, stats in sorted(self.sections.items()):
+            lines.append('Section %s: %d pages (%d written) in %.2fs' % (
+                section, stats['pages'], stats['written'], stats['seconds']))
+        return '\n'.join(lines)
+
+    def metrics(self):
+        '''
+        Yields (name, value, tags) for every figure of the run.
+        '''
+        yield 'duration', self.duration, {}
+        for name, seconds in self.phases.items():
+            yield 'phase.duration', seconds, {'phase': name}
+        for section, stats in self.sections.items():
+            for key, value in stats.items():
+                yield 'section.%s' % key, value, {'section': section}
+        yield 'manifest.hit', int(bool(self.manifest_hit)), {}
+        yield 'fingerprint.hit_rate', self.fingerprint_hit_rate, {}
+        yield 'culled', self.culled, {}
+        for operation, stat in self.storage_ops.items():
+            yield 'storage.count', stat['count'], {'operation': operation}
+            yield 'storage.seconds', stat['seconds'], {'operation': operation}
+
+    def emit(self, callback):
+        for name, value, tags in self.metrics():
+            try:
+                callback('static_sitemaps.%s' % name, value, tags)
+            except Exception:
+                # Metrics must never break sitemap generation.
+                logger.exception('Metrics callback failed for %s', name)
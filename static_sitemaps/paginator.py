@@ -0,0 +1,70 @@
+'''
+Keyset (seek) pagination for large sitemap querysets.
+
+Django's Paginator needs a COUNT(*) and pages with OFFSET, which gets slower the
+deeper the page. This paginator walks the key index instead, so every page is a
+``WHERE key > last_seen ORDER BY key LIMIT n`` query.
+'''
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger
+
+
+class KeysetPaginator(object):
+    def __init__(self, queryset, per_page, key='pk'):
+        # A leading '-' walks the key in descending order, like order_by().
+        self.descending = key.startswith('-')
+        self.key = key.lstrip('-')
+        self.queryset = queryset.order_by(key)
+        self.per_page = int(per_page)
+        self._page_starts = None
+
+    def after(self, queryset, value):
+        if value is None:
+            return queryset
+        lookup = '%s__%s' % (self.key, 'lt' if self.descending else 'gt')
+        return queryset.filter(**{lookup: value})
+
+    @property
+    def page_starts(self):
+        '''
+        Key value each page starts after, None for the first page.
+
+        Found by seeking per_page keys ahead of the previous boundary on the key alone,
+        which gives the same boundaries as slicing the ordered queryset.
+        '''
+        if self._page_starts is None:
+            keys = self.queryset.values_list(self.key, flat=True)
+            starts = [None]
+            while True:
+                # Last key of the current page, plus the first one of the next page if there is any.
+                window = list(self.after(keys, starts[-1])[self.per_page - 1:self.per_page + 1])
+                if len(window) < 2:
+                    break
+                starts.append(window[0])
+            self._page_starts = starts
+        return self._page_starts
+
+    @property
+    def num_pages(self):
+        return len(self.page_starts)
+
+    @property
+    def page_range(self):
+        return range(1, self.num_pages + 1)
+
+    def validate_number(self, number):
+        try:
+            if isinstance(number, float) and not number.is_integer():
+                raise ValueError
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        if number > self.num_pages:
+            raise EmptyPage('That page contains no results')
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        object_list = self.after(self.queryset, self.page_starts[number - 1])[:self.per_page]
+        return Page(object_list, number, self)
@@ -0,0 +1,82 @@
+'''
+Worker pools for writing sitemap pages concurrently.
+
+Each task queries, renders, compresses and uploads one page (which may result
+in several files if it had to be split). Results come back in task order, as
+they complete, so the index is identical to the one written serially.
+'''
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.db import connections
+from django.utils import translation
+
+from static_sitemaps.metrics import RunSummary
+
+# Generator living in each worker process, set up by _init_process.
+_process_generator = None
+
+
+def _write_part_in_thread(generator, task):
+    section, page = task
+    try:
+        # Active language is thread local, so set it for the worker thread too.
+        with translation.override(generator.language):
+            return generator.write_part(section, page)
+    finally:
+        # Connections are per thread as well, don't leave them dangling in the pool.
+        connections.close_all()
+
+
+def _init_process(generator_class, verbosity, target, state):
+    global _process_generator
+    # Inherited connections belong to the parent, make the worker open its own.
+    connections.close_all()
+    _process_generator = generator_class(verbosity=verbosity, jobs=1, target=target)
+    for name, value in state.items():
+        setattr(_process_generator, name, value)
+    translation.activate(_process_generator.language)
+
+
+def _write_part_in_process(task):
+    section, page = task
+    generator = _process_generator
+    generator.unmodified_pages = set()
+    generator.summary = RunSummary()
+    parts = generator.write_part(section, page)
+    # The parent's barrier can't see this process' uploads, finish them before reporting back.
+    generator.io.barrier()
+    io_stats, generator.io.stats = generator.io.stats, {}
+    return parts, generator.unmodified_pages, io_stats, generator.summary.sections
+
+
+def iter_parts(generator, tasks, jobs, pool='thread'):
+    '''
+    Writes pages for all (section, page) tasks using a pool of workers, yielding (task, index parts) in task order.
+    '''
+    if pool == 'thread':
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for task, parts in zip(tasks, executor.map(lambda task: _write_part_in_thread(generator, task), tasks)):
+                yield task, parts
+        return
+
+    # Don't hand open connections over to the forked children.
+    connections.close_all()
+    executor = ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=_init_process,
+        initargs=(generator.__class__, generator.verbosity, generator.target, {
+            'current_files': generator.current_files,
+            'previous_manifest': generator.previous_manifest,
+            # Reuse the parent's sitemaps, pagination (e.g. keyset page boundaries) is already worked out.
+            'sitemap_instances': generator.sitemap_instances,
+        }),
+    )
+    with executor:
+        for task, (parts, unmodified_pages, io_stats, sections) in zip(
+                tasks, executor.map(_write_part_in_process, tasks)):
+            generator.unmodified_pages.update(unmodified_pages)
+            generator.io.merge_stats(io_stats)
+            generator.summary.merge_sections(sections)
+            yield task, parts
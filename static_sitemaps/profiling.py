@@ -0,0 +1,97 @@
+'''
+Profiling of generator runs, used by ``refresh_sitemap --profile``.
+
+Each phase of the run (see SitemapGenerator.phase) is profiled with cProfile
+and gets a tracemalloc snapshot diff, so the report shows the top functions
+and allocation sites phase by phase. Only the thread running the phase is
+profiled, work done by --jobs pools isn't.
+'''
+import contextlib
+import cProfile
+import inspect
+import io
+import os
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+
+# Leave the profiler's own allocations out of the report, including this module and the
+# contextlib machinery of the phase context managers.
+_IGNORED = [
+    tracemalloc.Filter(False, filename)
+    for filename in [module.__file__ for module in (cProfile, pstats, tracemalloc, contextlib)] + [__file__]
+]
+
+
+def _get_line_filters(func):
+    func = inspect.unwrap(func)
+    lines, start = inspect.getsourcelines(func)
+    filename = inspect.getsourcefile(func)
+    return [tracemalloc.Filter(False, filename, lineno) for lineno in range(start, start + len(lines))]
+
+
+class PhaseProfiler(object):
+    def __init__(self, top=20, ignore=()):
+        '''
+        Allocations made on the lines of the ``ignore`` functions (e.g. the code
+        entering the phases) are left out of the report too.
+        '''
+        self.top = top
+        self.filters = list(_IGNORED)
+        for func in ignore:
+            self.filters.extend(_get_line_filters(func))
+        self.stats = {}
+        self.allocations = {}
+        self.order = []
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(self.filters)
+
+    def start(self):
+        tracemalloc.start()
+
+    def stop(self):
+        tracemalloc.stop()
+
+    @contextmanager
+    def profile(self, name):
+        if name not in self.order:
+            self.order.append(name)
+        before = self._snapshot() if tracemalloc.is_tracing() else None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if name in self.stats:
+                self.stats[name].add(profiler)
+            else:
+                self.stats[name] = pstats.Stats(profiler)
+            if before is not None:
+                # Same phase running again (e.g. per target) adds up.
+                diff = self._snapshot().compare_to(before, 'lineno')
+                self.allocations.setdefault(name, []).extend(diff)
+
+    def format(self):
+        out = io.StringIO()
+        for name in self.order:
+            out.write('==== Phase %s ====\n' % name)
+            stats = self.stats[name]
+            stats.stream = out
+            stats.sort_stats('cumulative').print_stats(self.top)
+            allocations = sorted(self.allocations.get(name, []), key=lambda stat: stat.size_diff, reverse=True)
+            if allocations:
+                out.write('Top allocation sites:\n')
+                for stat in allocations[:self.top]:
+                    out.write('  %s\n' % stat)
+            out.write('\n')
+        return out.getvalue()
+
+    def dump(self, directory):
+        '''
+        Writes <phase>.prof files, e.g. for snakeviz or pstats.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        for name, stats in self.stats.items():
+            stats.dump_stats(os.path.join(directory, '%s.prof' % name))
@@ -0,0 +1,98 @@
+'''
+Cheap lookup of the current sitemap index for the serving views.
+
+Keeps the index path and URL in process memory for a short TTL, backed by the
+Django cache under a versioned key. Only on a miss in both is the storage
+consulted, and concurrent misses are coalesced so a burst of crawler requests
+results in a single lookup instead of one per request.
+'''
+import threading
+import time
+
+from django.core.cache import cache
+
+from static_sitemaps import conf
+from static_sitemaps.util import _lazy_load
+
+# Bump when the cached value changes shape.
+CACHE_VERSION = 1
+
+
+class IndexResolver(object):
+    def __init__(self, ttl=None, cache_key=None):
+        self.ttl = conf.RESOLVER_TTL if ttl is None else ttl
+        self.cache_key = cache_key or '%s.index' % conf.CACHE_KEY
+        self.lock_key = '%s.lock' % self.cache_key
+        self._storage = None
+        self._entry = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    @property
+    def storage(self):
+        # One storage instance per process, instead of one per request.
+        if self._storage is None:
+            self._storage = _lazy_load(conf.STORAGE_CLASS)()
+        return self._storage
+
+    def _remember(self, entry):
+        self._entry = entry
+        self._expires = time.time() + self.ttl
+
+    def _from_memory(self):
+        if self._entry is not None and time.time() < self._expires:
+            return self._entry
+        return None
+
+    def publish(self, path, url):
+        '''
+        Stores the current index, called by the generator whenever it writes the index.
+        '''
+        entry = {'path': path, 'url': url}
+        cache.set(self.cache_key, entry, None, version=CACHE_VERSION)
+        self._remember(entry)
+
+    def invalidate(self):
+        self._entry = None
+        self._expires = 0
+
+    def get(self):
+        '''
+        Returns dict with 'path' and 'url' of the current index.
+        '''
+        entry = self._from_memory()
+        if entry is not None:
+            return entry
+        with self._lock:
+            # Another thread may have resolved it while we waited.
+            entry = self._from_memory()
+            if entry is not None:
+                return entry
+            entry = cache.get(self.cache_key, version=CACHE_VERSION)
+            if entry is None:
+                entry = self._resolve()
+            self._remember(entry)
+            return entry
+
+    def _resolve(self):
+        # Only one process lists storage, the others wait a moment for its result.
+        if not cache.add(self.lock_key, 1, conf.RESOLVER_LOCK_TIMEOUT, version=CACHE_VERSION):
+            deadline = time.time() + conf.RESOLVER_LOCK_TIMEOUT
+            while time.time() < deadline:
+                time.sleep(0.05)
+                entry = cache.get(self.cache_key, version=CACHE_VERSION)
+                if entry is not None:
+                    return entry
+        try:
+            from static_sitemaps.generator import SitemapGenerator
+            generator = SitemapGenerator(verbosity=0)
+            generator.out("Sitemap index cache miss: %s" % self.cache_key, 1)
+            path = generator.get_index_file_path()
+            entry = {'path': path, 'url': self.storage.url(path)}
+            cache.set(self.cache_key, entry, None, version=CACHE_VERSION)
+            return entry
+        finally:
+            cache.delete(self.lock_key, version=CACHE_VERSION)
+
+
+resolver = IndexResolver()
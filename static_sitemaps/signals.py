@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# Sent after every generator run with the generator and its RunSummary.
+sitemaps_generated = Signal()
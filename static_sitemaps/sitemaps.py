@@ -0,0 +1,102 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import QuerySet
+
+from static_sitemaps.paginator import KeysetPaginator
+
+
+class KeysetSitemapMixin(object):
+    '''
+    Paginates the sitemap by seeking on an ordered unique key instead of COUNT + OFFSET.
+
+    Mix into a Sitemap whose items() returns a queryset and set keyset_field to a
+    unique, indexed field ('-field' walks it descending). Page numbers stay the same
+    as with the default paginator as long as items() was ordered by that key.
+    '''
+    keyset_field = 'pk'
+
+    @property
+    def paginator(self):
+        # Cached, the page boundaries are found once per run (the generator resets them).
+        if getattr(self, '_keyset_paginator', None) is None:
+            if getattr(self, 'i18n', False):
+                raise ImproperlyConfigured("KeysetSitemapMixin can't paginate i18n sitemaps")
+            self._keyset_paginator = KeysetPaginator(self.items(), self.limit, self.keyset_field)
+        return self._keyset_paginator
+
+    def reset_paginator(self):
+        '''
+        Drops the cached page boundaries, so the next run finds them again.
+        '''
+        self._keyset_paginator = None
+
+
+class UrlRecord(object):
+    '''
+    Compact URL record, readable like the url dicts of Sitemap.get_urls() (without 'item').
+    '''
+    __slots__ = ('location', 'lastmod', 'changefreq', 'priority', 'alternates')
+
+    def __init__(self, location, lastmod=None, changefreq=None, priority='', alternates=()):
+        self.location = location
+        self.lastmod = lastmod
+        self.changefreq = changefreq
+        self.priority = priority
+        self.alternates = alternates
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+class LeanSitemapMixin(object):
+    '''
+    Lets the generator stream the page's items into compact UrlRecords instead of get_urls() dicts.
+
+    Querysets are iterated with .iterator(), so model instances are dropped as soon as their
+    record is built. Set lean_fields to fetch only those fields (as named tuples from
+    values_list()), in which case location(), lastmod() etc. get such a row instead of
+    a model instance. Records carry no 'item', so custom templates can't use it.
+    '''
+    lean_fields = None
+    lean_chunk_size = 2000
+
+    def iter_page_items(self, page=1, limit=None, paginator=None):
+        '''
+        Yields the items of page (rows if lean_fields is set), at most limit of them if given.
+
+        Pass the paginator to use for all pages, Sitemap.paginator is a new one (and COUNT query) on every access.
+        '''
+        if getattr(self, 'i18n', False):
+            raise ImproperlyConfigured("LeanSitemapMixin can't build URLs of i18n sitemaps")
+        object_list = (paginator or self.paginator).page(page).object_list
+        if limit:
+            # Sliced before fetching, so items over the limit never get loaded.
+            object_list = object_list[:limit]
+        if isinstance(object_list, QuerySet):
+            if self.lean_fields:
+                object_list = object_list.values_list(*self.lean_fields, named=True)
+            object_list = object_list.iterator(chunk_size=self.lean_chunk_size)
+        return object_list
+
+    def get_url_record(self, item, protocol, domain):
+        priority = self._get('priority', item)
+        return UrlRecord(
+            '%s://%s%s' % (protocol, domain, self._location(item)),
+            self._get('lastmod', item),
+            self._get('changefreq', item),
+            str(priority if priority is not None else ''),
+        )
+
+    def iter_url_records(self, page=1, site=None, protocol=None, limit=None, paginator=None):
+        '''
+        Yields UrlRecord for the items of page, at most limit of them if given.
+        '''
+        protocol = self.get_protocol(protocol)
+        domain = self.get_domain(site)
+        for item in self.iter_page_items(page, limit, paginator):
+            yield self.get_url_record(item, protocol, domain)
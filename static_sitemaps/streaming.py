@@ -0,0 +1,95 @@
+'''
+Streaming serializer for sitemap pages.
+
+Produces the same bytes as Django's default ``sitemap.xml`` template, but
+yields them in chunks instead of rendering the whole page through the
+template engine, so a page never has to exist in memory as a single string.
+'''
+import os
+import tempfile
+from datetime import date
+from html import escape
+
+import django.contrib.sitemaps
+from django.template import TemplateDoesNotExist, loader
+from django.template.defaultfilters import date as date_filter
+from django.utils.timezone import template_localtime
+
+URLSET_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" xmlns:xhtml="http://www.w3.org/1999/xhtml">\n'
+)
+URLSET_FOOTER = '\n</urlset>\n'
+
+# How many <url> entries to join into a single chunk before yielding it.
+URLS_PER_CHUNK = 500
+
+# The template the writer mirrors.
+DEFAULT_TEMPLATE_PATH = os.path.join(os.path.dirname(django.contrib.sitemaps.__file__), 'templates', 'sitemap.xml')
+
+
+def is_default_template(template_name='sitemap.xml'):
+    '''
+    Whether template_name resolves to django.contrib.sitemaps' own template, i.e. the project doesn't override it.
+    '''
+    try:
+        template = loader.get_template(template_name)
+    except TemplateDoesNotExist:
+        return False
+    name = getattr(getattr(template, 'origin', None), 'name', None)
+    return name is not None and os.path.realpath(name) == os.path.realpath(DEFAULT_TEMPLATE_PATH)
+
+
+def format_lastmod(lastmod):
+    # Mirrors {{ url.lastmod|date:"Y-m-d" }}, without the template machinery.
+    if isinstance(lastmod, date):
+        lastmod = template_localtime(lastmod)
+        return '%04d-%02d-%02d' % (lastmod.year, lastmod.month, lastmod.day)
+    return date_filter(lastmod, 'Y-m-d')
+
+
+def render_url(url):
+    parts = ['<url><loc>', escape(str(url['location'])), '</loc>']
+    if url.get('lastmod'):
+        parts += ['<lastmod>', format_lastmod(url['lastmod']), '</lastmod>']
+    if url.get('changefreq'):
+        parts += ['<changefreq>', escape(str(url['changefreq'])), '</changefreq>']
+    if url.get('priority'):
+        parts += ['<priority>', escape(str(url['priority'])), '</priority>']
+    for alternate in url.get('alternates') or ():
+        parts += [
+            '<xhtml:link rel="alternate" hreflang="', escape(str(alternate['lang_code'])),
+            '" href="', escape(str(alternate['location'])), '"/>',
+        ]
+    parts.append('</url>')
+    return ''.join(parts)
+
+
+def iter_urlset(urls, encoding='utf_8'):
+    '''
+    Yields the encoded urlset document for ``urls`` chunk by chunk.
+    '''
+    yield URLSET_HEADER.encode(encoding)
+    batch = []
+    for url in urls:
+        batch.append(render_url(url))
+        if len(batch) >= URLS_PER_CHUNK:
+            yield ''.join(batch).encode(encoding)
+            batch = []
+    if batch:
+        yield ''.join(batch).encode(encoding)
+    yield URLSET_FOOTER.encode(encoding)
+
+
+def spool(chunks, hasher, max_size):
+    '''
+    Writes chunks to a spooled temp file (in memory up to max_size, then on disk), feeding the
+    hasher along the way. Returned file is rewound and ready to read.
+    '''
+    buf = tempfile.SpooledTemporaryFile(max_size=max_size)
+    for chunk in chunks:
+        hasher.update(chunk)
+        buf.write(chunk)
+    buf.seek(0)
+    return buf
+
@@ -0,0 +1,54 @@
+'''
+Targets the sitemaps are generated for.
+
+A target is one (language, site, protocol) combination with its own ROOT_DIR
+and cache key. By default there's a single target built from the
+STATICSITEMAPS_LANGUAGE, MOCK_SITE, ROOT_DIR and CACHE_KEY settings;
+``STATICSITEMAPS_TARGETS`` lists several, which MultiTargetGenerator then
+writes from one pass over the database.
+'''
+import os
+
+from django.core.exceptions import ImproperlyConfigured
+
+from static_sitemaps import conf
+
+
+class Target(object):
+    def __init__(self, name=None, language=None, site=None, protocol=None, root_dir=None, cache_key=None):
+        self.name = name
+        self.language = language or conf.LANGUAGE
+        # Domain to build URLs for. Without one, MOCK_SITE or the sites framework decide as usual.
+        self.site = site
+        self.protocol = protocol
+        if name is None:
+            self.root_dir = root_dir or conf.ROOT_DIR
+            self.page_dir = conf.PAGES_DIR if root_dir is None else os.path.join(root_dir, 'pages')
+            self.cache_key = cache_key or conf.CACHE_KEY
+        else:
+            self.root_dir = root_dir or os.path.join(conf.ROOT_DIR, name)
+            self.page_dir = os.path.join(self.root_dir, 'pages')
+            self.cache_key = cache_key or '%s.%s' % (conf.CACHE_KEY, name)
+
+    @property
+    def is_default(self):
+        '''
+        The default target is the one served by the static_sitemaps views.
+        '''
+        return self.root_dir == conf.ROOT_DIR and self.cache_key == conf.CACHE_KEY
+
+    def __repr__(self):
+        return '<Target %s: %s %s>' % (self.name or 'default', self.language, self.site or '-')
+
+
+def get_targets():
+    '''
+    Returns the configured targets, a single default one unless STATICSITEMAPS_TARGETS is set.
+    '''
+    if not conf.TARGETS:
+        return [Target()]
+    targets = [Target(**options) for options in conf.TARGETS]
+    root_dirs = [target.root_dir for target in targets]
+    if len(set(root_dirs)) != len(root_dirs):
+        raise ImproperlyConfigured("STATICSITEMAPS_TARGETS must each have their own root_dir")
+    return targets
@@ -1,15 +1,21 @@
+import logging
 from datetime import timedelta
 
 from celery import Celery
-from celery import shared_task
+from celery import chord, shared_task
+from django.utils import translation
+from django.utils.dateparse import parse_datetime
 
 app = Celery()
 
-from static_sitemaps import conf
-from static_sitemaps.generator import SitemapGenerator
+from static_sitemaps import conf, dirty
+from static_sitemaps.generator import MultiTargetGenerator, SitemapGenerator
+from static_sitemaps.lock import Heartbeat, RefreshLock
 
 __author__ = 'xaralis'
 
+logger = logging.getLogger(__name__)
+
 # Register the task conditionally so the task can be bypassed when repetition
 # is set to something which evaluates to False.
 if conf.CELERY_TASK_REPETITION:
@@ -21,7 +27,167 @@ if conf.CELERY_TASK_REPETITION:
             expires=600, # If hasn't started in 10m, don't risk overlap
         )
 
+
+def _get_generator(heartbeat, resume=False):
+    # Progress goes to the static_sitemaps loggers, the summary is the task result.
+    if conf.TARGETS:
+        generator = MultiTargetGenerator(verbosity=0)
+        generators = generator.generators
+    else:
+        generator = SitemapGenerator(verbosity=0)
+        generators = [generator]
+    for target_generator in generators:
+        target_generator.resume = resume
+        # Checked before writing the index and culling.
+        target_generator.heartbeat = heartbeat
+    return generator
+
+
+def _summary_result(summary):
+    # One summary per target when generating several.
+    if isinstance(summary, list):
+        return [target_summary.to_dict() for target_summary in summary]
+    return summary.to_dict()
+
+
+def _dump_part(part):
+    # Task results go through the serializer, keep them plain.
+    part = dict(part)
+    if part['lastmod'] is not None:
+        part['lastmod'] = part['lastmod'].isoformat()
+    return part
+
+
+def _load_part(part):
+    part = dict(part)
+    if part['lastmod'] is not None:
+        part['lastmod'] = parse_datetime(part['lastmod'])
+    return part
+
+
 @shared_task
 def generate_sitemap():
-    generator = SitemapGenerator(verbosity=1)
-    generator.write()
+    lock = RefreshLock()
+    run_id = lock.acquire()
+    if run_id is None:
+        logger.info('Sitemap refresh already running, skipping.')
+        return {'skipped': True}
+    if conf.CELERY_DISTRIBUTED:
+        return _start_distributed(lock, run_id)
+    try:
+        with Heartbeat(lock, run_id) as heartbeat:
+            # Runs killed on the way (expires, OOM, DB timeouts) get picked up where they stopped.
+            return _summary_result(_get_generator(heartbeat, resume=True).write())
+    finally:
+        lock.release(run_id)
+
+
+def _start_distributed(lock, run_id):
+    '''
+    Fans pages out to write_sitemap_pages subtasks, with finish_sitemap writing the index once all are done.
+    '''
+    try:
+        generator = SitemapGenerator(verbosity=0)
+        tasks = generator.get_page_tasks()
+        size = conf.CELERY_PAGES_PER_TASK
+        chunks = [tasks[i:i + size] for i in range(0, len(tasks), size)]
+        logger.info('Sitemap refresh %s: %d pages in %d subtasks.', run_id, len(tasks), len(chunks))
+        if chunks:
+            generator.mark_unfinished()
+            callback = finish_sitemap.s(run_id).on_error(release_sitemap_lock.si(run_id))
+            # Pagination is worked out once here. Without it every subtask would count rows and walk
+            # keyset page boundaries again, one query per page.
+            chord(
+                write_sitemap_pages.s(run_id, chunk, generator.get_pagination(set(section for section, page in chunk)))
+                for chunk in chunks
+            )(callback)
+    except BaseException:
+        # E.g. the database or the broker being down, don't leave refreshes locked out until the lock expires.
+        lock.release(run_id)
+        raise
+    if not chunks:
+        return finish_sitemap([], run_id)
+    return {'run_id': run_id, 'pages': len(tasks), 'subtasks': len(chunks)}
+
+
+@shared_task
+def write_sitemap_pages(run_id, tasks, pagination=None):
+    '''
+    Writes the given (section, page) pages of a distributed refresh, returning their index parts.
+    '''
+    lock = RefreshLock()
+    # Bail out if the run was declared dead and taken over meanwhile.
+    lock.heartbeat(run_id)
+    generator = SitemapGenerator(verbosity=0)
+    if pagination:
+        generator.set_pagination(pagination)
+    try:
+        generator.load_current_files()
+        with Heartbeat(lock, run_id) as heartbeat, translation.override(generator.language):
+            generator.heartbeat = heartbeat
+            # All at once, so JOBS > 1 writes the chunk with a single pool.
+            parts = generator.write_pages(tasks)
+            # Parts of a run taken over meanwhile are of no use.
+            generator.check_lock()
+    finally:
+        generator.io.close()
+    return {
+        'parts': [_dump_part(part) for part in parts],
+        'unmodified': sorted(generator.unmodified_pages),
+        'sections': generator.summary.sections,
+    }
+
+
+@shared_task
+def finish_sitemap(results, run_id):
+    '''
+    Chord callback of a distributed refresh: writes the index from all parts, culls and releases the lock.
+    '''
+    lock = RefreshLock()
+    try:
+        lock.heartbeat(run_id)
+        generator = SitemapGenerator(verbosity=0)
+        parts = []
+        # Chord results come in the order of the subtasks, so parts keep the index order.
+        for result in results:
+            parts.extend(_load_part(part) for part in result['parts'])
+            generator.unmodified_pages.update(result['unmodified'])
+            generator.summary.merge_sections(result['sections'])
+        with Heartbeat(lock, run_id) as heartbeat:
+            generator.heartbeat = heartbeat
+            return generator.write(parts=parts).to_dict()
+    finally:
+        lock.release(run_id)
+
+
+@shared_task
+def refresh_dirty_sitemap():
+    '''
+    Regenerates the sections marked dirty by model changes, reusing the previous run's pages for the others.
+    '''
+    dirty.clear_scheduled()
+    lock = RefreshLock()
+    run_id = lock.acquire()
+    if run_id is None:
+        # Sections stay dirty, try again once the running refresh is done.
+        dirty.schedule_refresh()
+        return {'skipped': True}
+    sections = []
+    try:
+        with Heartbeat(lock, run_id) as heartbeat:
+            generator = _get_generator(heartbeat)
+            sections = dirty.pop_dirty_sections(generator.sitemaps)
+            if not sections:
+                return {'skipped': True}
+            return _summary_result(generator.write(sections=sections))
+    except BaseException:
+        if sections:
+            dirty.mark_dirty(sections, schedule=False)
+        raise
+    finally:
+        lock.release(run_id)
+
+
+@shared_task
+def release_sitemap_lock(run_id):
+    RefreshLock().release(run_id)
@@ -1,34 +1,283 @@
+import gzip
 import os
-from django.http import Http404, HttpResponseRedirect, FileResponse
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
 
 from . import conf
+from .compression import PRECOMPRESSED_PREFERENCE, get_variant_path
 from .generator import SitemapGenerator
+from .resolver import resolver
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+RANGE_CHUNK_SIZE = 64 * 1024
+
+
+def _etag(file_path, decompress=False):
+    # File names are content addressed, so the name alone is a strong validator.
+    if decompress:
+        # Distinct from the gzip file's validator, it's a different representation.
+        return '"%s.identity"' % os.path.basename(file_path)
+    return '"%s"' % os.path.basename(file_path)
+
+
+def _accepted_encodings(header):
+    '''
+    Returns {coding: qvalue} parsed from an Accept-Encoding header.
+    '''
+    codings = {}
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def _negotiate(request, file_path):
+    '''
+    Returns (path, content encoding, decompress) candidates for serving a page, best first.
+    '''
+    header = request.META.get('HTTP_ACCEPT_ENCODING')
+    primary = (file_path, 'gzip' if conf.USE_GZIP else None, False)
+    if header is None:
+        # Clients not saying anything always got the stored file, keep it that way.
+        return [primary]
+    codings = _accepted_encodings(header)
+
+    def accepts(coding):
+        if coding in codings:
+            return codings[coding] > 0
+        if coding == 'identity':
+            return codings.get('*', 1) > 0
+        return codings.get('*', 0) > 0
 
+    candidates = [
+        (get_variant_path(file_path, encoding), encoding, False)
+        for encoding in PRECOMPRESSED_PREFERENCE
+        if encoding in conf.PRECOMPRESSED and accepts(encoding)
+    ]
+    if conf.USE_GZIP and not accepts('gzip'):
+        # Only gzip is stored, but the client can't take it.
+        candidates.append((file_path, None, True))
+    else:
+        # Uncompressed pages are sent as stored, even to clients refusing identity.
+        candidates.append(primary)
+    return candidates
 
-def _passthru(generator, file_path, allow_gzip=True):
+
+def _iter_decompressed(f):
     try:
-        response = FileResponse(generator.storage.open(file_path), content_type='application/xml')
-    except IOError:
-        raise Http404("Sitemap not found")
-    if conf.USE_GZIP and allow_gzip:
-        response['Content-Encoding'] = 'gzip'
+        with gzip.GzipFile(fileobj=f, mode='rb') as decompressed:
+            while True:
+                chunk = decompressed.read(RANGE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        f.close()
+
+
+def _offload(storage, file_path):
+    '''
+    Returns response handing the file over to the web server, or None if offloading is off.
+    '''
+    if conf.PASSTHRU_OFFLOAD == 'x-accel-redirect':
+        response = HttpResponse(content_type='application/xml')
+        response['X-Accel-Redirect'] = conf.PASSTHRU_OFFLOAD_PREFIX + file_path
+        return response
+    if conf.PASSTHRU_OFFLOAD == 'x-sendfile':
+        try:
+            path = storage.path(file_path)
+        except NotImplementedError:
+            raise ImproperlyConfigured("X-Sendfile needs a storage with local paths")
+        response = HttpResponse(content_type='application/xml')
+        response['X-Sendfile'] = path
+        return response
+    return None
+
+
+def _parse_range(header, size):
+    '''
+    Returns (start, end) of a single "bytes=" range, None when it should be ignored. Raises ValueError if unsatisfiable.
+    '''
+    match = RANGE_RE.match(header or '')
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start:
+        if not end:
+            return None
+        # Suffix range, the last N bytes.
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError
+    return start, end
+
+
+def _iter_range(f, start, length):
+    try:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def _open_candidate(storage, candidates):
+    '''
+    Returns (f, path, encoding, decompress) of the first candidate found in storage.
+    '''
+    for path, encoding, decompress in candidates:
+        try:
+            return storage.open(path), path, encoding, decompress
+        except IOError:
+            # Precompressed siblings are missing for pages written before they were enabled.
+            continue
+    raise Http404("Sitemap not found")
+
+
+def _revalidate(request, candidates):
+    '''
+    Returns (304 response, encoding) if the client already has one of the candidates, or None.
+    '''
+    if 'HTTP_IF_NONE_MATCH' not in request.META:
+        return None
+    for path, encoding, decompress in candidates:
+        etag = _etag(path, decompress)
+        response = get_conditional_response(request, etag=etag)
+        if response is not None and response.status_code == 304:
+            response['ETag'] = etag
+            return response, encoding
+    return None
+
+
+def _offload_candidate(storage, candidates):
+    '''
+    Returns (response, path, encoding) offloading the first candidate found in storage, or None.
+    '''
+    if not conf.PASSTHRU_OFFLOAD:
+        return None
+    for i, (path, encoding, decompress) in enumerate(candidates):
+        if decompress:
+            # The web server would send it as stored.
+            return None
+        # The page itself is assumed to exist, like without negotiation.
+        if i < len(candidates) - 1 and not storage.exists(path):
+            continue
+        response = _offload(storage, path)
+        return (response, path, encoding) if response is not None else None
+    return None
+
+
+def _passthru(request, storage, file_path, allow_gzip=True, immutable=True):
+    if allow_gzip:
+        candidates = _negotiate(request, file_path)
+    else:
+        candidates = [(file_path, None, False)]
+    # Answer revalidations before touching storage at all.
+    revalidated = _revalidate(request, candidates)
+    if revalidated is not None:
+        response, encoding = revalidated
+        return _finish(response, allow_gzip, immutable, encoding)
+    # Other preconditions are checked against the candidate actually served.
+    offloaded = _offload_candidate(storage, candidates)
+    if offloaded is not None:
+        response, path, encoding = offloaded
+        etag = _etag(path)
+        response = get_conditional_response(request, etag=etag) or response
+    else:
+        f, path, encoding, decompress = _open_candidate(storage, candidates)
+        etag = _etag(path, decompress)
+        response = get_conditional_response(request, etag=etag)
+        if response is not None:
+            f.close()
+    if response is None:
+        if decompress:
+            response = StreamingHttpResponse(_iter_decompressed(f), content_type='application/xml')
+            response['ETag'] = etag
+            return _finish(response, allow_gzip, immutable, None)
+        range_header = request.META.get('HTTP_RANGE')
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if range_header and (not if_range or if_range == etag):
+            size = f.size
+            try:
+                byte_range = _parse_range(range_header, size)
+            except ValueError:
+                f.close()
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % size
+                return response
+        else:
+            byte_range = None
+        if byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(_iter_range(f, start, end - start + 1),
+                                             status=206, content_type='application/xml')
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            response['Content-Length'] = str(end - start + 1)
+        else:
+            response = FileResponse(f, content_type='application/xml')
+        response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    return _finish(response, allow_gzip, immutable, encoding)
+
+
+def _finish(response, allow_gzip, immutable, encoding):
+    if immutable:
+        patch_cache_control(response, public=True, max_age=conf.PASSTHRU_MAX_AGE, immutable=True)
+    else:
+        # Same URL, changing content: cache but always revalidate, which the ETag makes cheap.
+        patch_cache_control(response, public=True, no_cache=True)
+    if allow_gzip and (conf.USE_GZIP or conf.PRECOMPRESSED):
+        patch_vary_headers(response, ('Accept-Encoding',))
+    if encoding and response.status_code in (200, 206):
+        response['Content-Encoding'] = encoding
     return response
 
 
+def _current_index():
+    try:
+        return resolver.get()
+    except AssertionError:
+        # No index generated yet.
+        raise Http404("Sitemap not found")
+
+
 def index_view(request):
-    generator = SitemapGenerator()
+    index = _current_index()
     if not conf.SERVE_VIA_PASSTHRU:
-        return HttpResponseRedirect(generator.get_index_url())
-    return _passthru(generator, generator.get_index_file_path(), allow_gzip=False)
+        return HttpResponseRedirect(index['url'])
+    try:
+        return _passthru(request, resolver.storage, index['path'], allow_gzip=False, immutable=False)
+    except Http404:
+        # Remembered index may have been replaced (and culled) by a newer run meanwhile.
+        resolver.invalidate()
+        return _passthru(request, resolver.storage, _current_index()['path'], allow_gzip=False, immutable=False)
 
 
 def page_view(request, filename):
-    generator = SitemapGenerator()
-    file_path = os.path.join(generator.page_dir, filename)
-    if not generator.is_valid_page(filename):
-        generator.out("Sitemap file requested is not valid: %s" % file_path)
+    file_path = os.path.join(SitemapGenerator.page_dir, filename)
+    if not SitemapGenerator.is_valid_page(filename):
         raise Http404("Sitemap file requested is not valid: %s" % file_path)
     if not conf.SERVE_VIA_PASSTHRU:
-        return HttpResponseRedirect(generator.storage.url(file_path))
-    return _passthru(generator, file_path)
-
+        return HttpResponseRedirect(resolver.storage.url(file_path))
+    return _passthru(request, resolver.storage, file_path)